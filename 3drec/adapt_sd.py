@@ -33,10 +33,19 @@ def add_import_path(dirname):
         curr_dir() / str(dirname)
     ))
 
-def load_model_from_config(config, ckpt, verbose=False):
+def load_model_from_config(config, ckpt, verbose=False, inference=True):
+    """inference=True memory-maps the checkpoint and loads only its EMA weights,
+    frozen, so the ema_scope of every denoise / encode / decode call is a no-op.
+    inference=False loads the raw weights and the EMA as configured."""
+    from ldm.checkpoint import load_checkpoint, load_model
+    if inference:
+        model = load_model(config, ckpt, device, verbose=verbose)
+        model.requires_grad_(False)
+        return model
+
     from ldm.util import instantiate_from_config
     print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location="cpu")
+    pl_sd = load_checkpoint(ckpt)
     if "global_step" in pl_sd:
         print(f"Global Step: {pl_sd['global_step']}")
     sd = pl_sd["state_dict"]
@@ -12,26 +12,12 @@ from omegaconf import OmegaConf
 from PIL import Image
 from torch import autocast
 from torchvision import transforms
-from ldm.util import load_and_preprocess, instantiate_from_config
+from ldm.checkpoint import load_model
+from ldm.background import BackgroundRemovalService
 
 def load_model_from_config(config, ckpt, device, verbose=False):
-    print(f"Loading model from {ckpt}")
-    pl_sd = torch.load(ckpt, map_location=device)
-    if "global_step" in pl_sd:
-        print(f"Global Step: {pl_sd['global_step']}")
-    sd = pl_sd["state_dict"]
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print("missing keys:")
-        print(m)
-    if len(u) > 0 and verbose:
-        print("unexpected keys:")
-        print(u)
-
-    model.to(device)
-    model.eval()
-    return model
+    # memory-mapped, EMA weights only; also accepts `python -m ldm.checkpoint slim`
+    return load_model(config, ckpt, device, verbose=verbose)
 
 @torch.no_grad()
 def sample_model(input_im, model, sampler, precision, h, w, ddim_steps, n_samples, scale, \
@@ -75,6 +61,7 @@ def sample_model(input_im, model, sampler, precision, h, w, ddim_steps, n_sample
 def main(
     model,
     device,
+    background,
     input_im,
     x=0.,
     y=0.,
@@ -91,7 +78,7 @@ def main(
     # input_im[input_im == [0., 0., 0.]] = [1., 1., 1., 1.]
     print(input_im.size)
     if preprocess:
-        input_im = load_and_preprocess(input_im)
+        input_im = background(input_im)
     else:
         input_im = input_im.resize([256, 256], Image.Resampling.LANCZOS)
         input_im = np.asarray(input_im, dtype=np.float32) / 255.
@@ -142,6 +129,7 @@ def run_demo(
     device = f"cuda:{device_idx}"
     config = OmegaConf.load(config)
     model = load_model_from_config(config, ckpt, device=device)
+    background = BackgroundRemovalService()
 
     inputs = [
         gr.Image(type="pil", image_mode="RGBA"), # shape=[512, 512]
@@ -156,7 +144,7 @@ def run_demo(
     output = gr.Gallery(label="Generated variations")
     output.style(grid=2)
 
-    fn_with_model = partial(main, model, device)
+    fn_with_model = partial(main, model, device, background)
     fn_with_model.__name__ = "fn_with_model"
 
     examples = [
@@ -178,7 +166,10 @@ def run_demo(
         examples=examples,
         allow_flagging="never",
         )
-    demo.launch(enable_queue=True, share=True)
+    try:
+        demo.launch(enable_queue=True, share=True)
+    finally:
+        background.close()
 
 if __name__ == "__main__":
     fire.Fire(run_demo)
\ No newline at end of file
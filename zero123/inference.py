@@ -1,85 +1,30 @@
 import os
-import math
 import fire
 import numpy as np
 import time
 
-import torch
-from contextlib import nullcontext
-from diffusers.pipelines.stable_diffusion import StableDiffusionSafetyChecker
 from einops import rearrange
-from ldm.models.diffusion.ddim import DDIMSampler
-from ldm.util import create_carvekit_interface, load_and_preprocess, instantiate_from_config
-from lovely_numpy import lo
+from ldm.checkpoint import load_model
+from ldm.engine import InferenceEngine
+from ldm.input_cache import InputCache
+from ldm.background import BackgroundRemovalService
 from omegaconf import OmegaConf
 from PIL import Image
-from rich import print
-from transformers import AutoFeatureExtractor
-from torch import autocast
 from torchvision import transforms
 
 
 _GPU_INDEX = 0
 
 
+def rprint(*args, **kwargs):
+    # rich is only imported once there is something to print
+    from rich import print as rich_print
+    rich_print(*args, **kwargs)
+
+
 def load_model_from_config(config, ckpt, device, verbose=False):
-    print(f'Loading model from {ckpt}')
-    pl_sd = torch.load(ckpt, map_location='cpu')
-    if 'global_step' in pl_sd:
-        print(f'Global Step: {pl_sd["global_step"]}')
-    sd = pl_sd['state_dict']
-    model = instantiate_from_config(config.model)
-    m, u = model.load_state_dict(sd, strict=False)
-    if len(m) > 0 and verbose:
-        print('missing keys:')
-        print(m)
-    if len(u) > 0 and verbose:
-        print('unexpected keys:')
-        print(u)
-
-    model.to(device)
-    model.eval()
-    return model
-
-
-@torch.no_grad()
-def sample_model(input_im, model, sampler, precision, h, w,
-                 ddim_steps, n_samples, scale, ddim_eta,
-                 elevation, azimuth, radius):
-    precision_scope = autocast if precision == 'autocast' else nullcontext
-    with precision_scope('cuda'):
-        with model.ema_scope():
-            c = model.get_learned_conditioning(input_im).tile(n_samples, 1, 1)
-            T = torch.tensor([elevation,
-                              math.sin(azimuth), math.cos(azimuth),
-                              radius])
-            T = T[None, None, :].repeat(n_samples, 1, 1).to(c.device)
-            c = torch.cat([c, T], dim=-1)
-            c = model.cc_projection(c)
-            cond = {}
-            cond['c_crossattn'] = [c]
-            cond['c_concat'] = [model.encode_first_stage((input_im.to(c.device))).mode().detach()
-                                .repeat(n_samples, 1, 1, 1)]
-            if scale != 1.0:
-                uc = {}
-                uc['c_concat'] = [torch.zeros(n_samples, 4, h // 8, w // 8).to(c.device)]
-                uc['c_crossattn'] = [torch.zeros_like(c).to(c.device)]
-            else:
-                uc = None
-
-            shape = [4, h // 8, w // 8]
-            samples_ddim, _ = sampler.sample(S=ddim_steps,
-                                             conditioning=cond,
-                                             batch_size=n_samples,
-                                             shape=shape,
-                                             verbose=False,
-                                             unconditional_guidance_scale=scale,
-                                             unconditional_conditioning=uc,
-                                             eta=ddim_eta,
-                                             x_T=None)
-            # print(samples_ddim.shape)
-            x_samples_ddim = model.decode_first_stage(samples_ddim)
-            return torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0).cpu()
+    # memory-mapped, EMA weights only; also accepts `python -m ldm.checkpoint slim`
+    return load_model(config, ckpt, device, verbose=verbose)
 
 
 def preprocess_image(models, input_im, preprocess):
@@ -88,11 +33,11 @@ def preprocess_image(models, input_im, preprocess):
     :return input_im (H, W, 3) array in [0, 1].
     '''
 
-    print('old input_im:', input_im.size)
+    rprint('old input_im:', input_im.size)
     start_time = time.time()
 
     if preprocess:
-        input_im = load_and_preprocess(models['carvekit'], input_im)
+        input_im = models['background'](input_im)
         input_im = (input_im / 255.0).astype(np.float32)
         # (H, W, 3) array in [0, 1].
     else:
@@ -112,12 +57,50 @@ def preprocess_image(models, input_im, preprocess):
         input_im = input_im[:, :, 0:3]
         # (H, W, 3) array in [0, 1].
 
-    print(f'Infer foreground mask (preprocess_image) took {time.time() - start_time:.3f}s.')
-    print('new input_im:', lo(input_im))
+    rprint(f'Infer foreground mask (preprocess_image) took {time.time() - start_time:.3f}s.')
+    from lovely_numpy import lo
+    rprint('new input_im:', lo(input_im))
 
     return input_im
 
 
+def model_input(input_im, device, h, w):
+    '''
+    :param input_im (H, W, 3) array in [0, 1].
+    :return [1, 3, h, w] Tensor in [-1, 1].
+    '''
+    input_im = transforms.ToTensor()(input_im).unsqueeze(0).to(device)
+    input_im = input_im * 2 - 1
+    return transforms.functional.resize(input_im, [h, w])
+
+
+def cached_input(models, device, raw_im, preprocess, h, w, precision, encode=True):
+    '''
+    Safety check, preprocess and, with encode, encode raw_im. Resubmitting the
+    same image skips the safety checker, carvekit and the encoders.
+    :return the cache entry of raw_im, see ldm/input_cache.py.
+    '''
+    cache = models['cache']
+    key = cache.key(raw_im, preprocess=preprocess, h=h, w=w, precision=precision)
+    entry = cache.get(key)
+    cached = len(entry)
+    if 'nsfw' not in entry:
+        safety_checker_input = models['clip_fe'](raw_im, return_tensors='pt').to(device)
+        (image, has_nsfw_concept) = models['nsfw'](
+            images=np.ones((1, 3)), clip_input=safety_checker_input.pixel_values)
+        rprint('has_nsfw_concept:', has_nsfw_concept)
+        entry['nsfw'] = bool(np.any(has_nsfw_concept))
+    if not entry['nsfw']:
+        if 'image' not in entry:
+            entry['image'] = preprocess_image(models, raw_im, preprocess)
+        if encode and 'encoded' not in entry:
+            entry['encoded'] = models['engine'].encode(
+                model_input(entry['image'], device, h, w), precision)
+    if len(entry) > cached:
+        cache.save(key, entry)
+    return entry
+
+
 def main_run(raw_im,
              models, device,
              elevation=0.0, azimuth=0.0, radius=0.0,
@@ -129,12 +112,9 @@ def main_run(raw_im,
     '''
     
     raw_im.thumbnail([1536, 1536], Image.Resampling.LANCZOS)
-    safety_checker_input = models['clip_fe'](raw_im, return_tensors='pt').to(device)
-    (image, has_nsfw_concept) = models['nsfw'](
-        images=np.ones((1, 3)), clip_input=safety_checker_input.pixel_values)
-    print('has_nsfw_concept:', has_nsfw_concept)
-    if np.any(has_nsfw_concept):
-        print('NSFW content detected.')
+    entry = cached_input(models, device, raw_im, preprocess, h, w, precision)
+    if entry['nsfw']:
+        rprint('NSFW content detected.')
         to_return = [None] * 10
         description = ('###  <span style="color:red"> Unfortunately, '
                        'potential NSFW content was detected, '
@@ -143,20 +123,16 @@ def main_run(raw_im,
         to_return[0] = description
         return to_return
     else:
-        print('Safety check passed.')
+        rprint('Safety check passed.')
 
-    input_im = preprocess_image(models, raw_im, preprocess)
-
-    input_im = transforms.ToTensor()(input_im).unsqueeze(0).to(device)
-    input_im = input_im * 2 - 1
-    input_im = transforms.functional.resize(input_im, [h, w])
+    input_im = model_input(entry['image'], device, h, w)
 
-    sampler = DDIMSampler(models['turncam'])
     # used_x = -x  # NOTE: Polar makes more sense in Basile's opinion this way!
     used_elevation = elevation  # NOTE: Set this way for consistency.
-    x_samples_ddim = sample_model(input_im, models['turncam'], sampler, precision, h, w,
-                                  ddim_steps, n_samples, scale, ddim_eta,
-                                  used_elevation, azimuth, radius)
+    x_samples_ddim = models['engine'].sample_pose(
+        input_im, (used_elevation, azimuth, radius), n_samples=n_samples,
+        ddim_steps=ddim_steps, scale=scale, ddim_eta=ddim_eta, precision=precision,
+        encoded=entry['encoded'])
 
     output_ims = []
     for x_sample in x_samples_ddim:
@@ -173,7 +149,8 @@ def predict(device_idx: int =_GPU_INDEX,
             elevation_in_degree: float = 0.0,
             azimuth_in_degree: float = 0.0,
             radius: float = 0.0,
-            output_image_path: str = "output.png"):
+            output_image_path: str = "output.png",
+            cache_dir: str = None):
     device = f"cuda:{device_idx}"
     config = OmegaConf.load(config)
 
@@ -182,24 +159,34 @@ def predict(device_idx: int =_GPU_INDEX,
 
     # Instantiate all models beforehand for efficiency.
     models = dict()
-    print('Instantiating LatentDiffusion...')
+    rprint('Instantiating LatentDiffusion...')
     models['turncam'] = load_model_from_config(config, ckpt, device=device)
-    print('Instantiating Carvekit HiInterface...')
-    models['carvekit'] = create_carvekit_interface()
-    print('Instantiating StableDiffusionSafetyChecker...')
+    # keeps one sampler and its schedules for all requests
+    models['engine'] = InferenceEngine(models['turncam'])
+    models['cache'] = InputCache(cache_dir=cache_dir, device=device)
+    rprint('Instantiating BackgroundRemovalService (Carvekit HiInterface)...')
+    # segments the inputs of concurrent requests in batches
+    models['background'] = BackgroundRemovalService()
+    # diffusers and transformers are only needed for the safety checker
+    from diffusers.pipelines.stable_diffusion import StableDiffusionSafetyChecker
+    from transformers import AutoFeatureExtractor
+    rprint('Instantiating StableDiffusionSafetyChecker...')
     models['nsfw'] = StableDiffusionSafetyChecker.from_pretrained(
         'CompVis/stable-diffusion-safety-checker').to(device)
-    print('Instantiating AutoFeatureExtractor...')
+    rprint('Instantiating AutoFeatureExtractor...')
     models['clip_fe'] = AutoFeatureExtractor.from_pretrained(
         'CompVis/stable-diffusion-safety-checker')
 
     cond_image = Image.open(cond_image_path)
 
-    preds_images = main_run(raw_im=cond_image,
-                            models=models, device=device,
-                            elevation=np.deg2rad(elevation_in_degree),
-                            azimuth=np.deg2rad(azimuth_in_degree),
-                            radius=radius)
+    try:
+        preds_images = main_run(raw_im=cond_image,
+                                models=models, device=device,
+                                elevation=np.deg2rad(elevation_in_degree),
+                                azimuth=np.deg2rad(azimuth_in_degree),
+                                radius=radius)
+    finally:
+        models['background'].close()
 
     pred_image = preds_images[-1]
     pred_image.save(output_image_path)
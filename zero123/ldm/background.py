@@ -0,0 +1,175 @@
+"""Batched background removal shared by concurrent requests.
+
+`create_carvekit_interface` / `load_and_preprocess` segment one image per call
+in the request path. `BackgroundRemovalService` instead queues images from any
+number of threads (demo requests, directory jobs), and a single segmentation
+thread runs carvekit on batches of up to `max_batch` of them. Only that thread
+touches the interface, so all workers share one copy of the weights. Cropping
+and recentering (`ldm.util.crop_foreground`) run on a pool of `num_workers`
+threads so that they overlap with the next segmentation batch.
+
+Every image records its queue, segmentation and postprocessing latency, see
+`BackgroundRemovalService.metrics`.
+
+Usage, to preprocess a directory of images:
+    python -m ldm.background --in_dir raw --out_dir preprocessed
+"""
+
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import fire
+import numpy as np
+from ldm.util import create_carvekit_interface, crop_foreground
+from PIL import Image
+
+LATENCY_STAGES = ["queue", "segment", "postprocess", "total"]
+
+
+class BackgroundRemovalService:
+    def __init__(
+        self, interface=None, max_batch=5, max_wait=0.01, num_workers=2, history=1000
+    ):
+        """
+        :param interface: carvekit `HiInterface`, created with
+            `create_carvekit_interface` if None.
+        :param max_batch: largest number of images segmented together.
+        :param max_wait: seconds the segmentation thread waits for more images
+            before it runs a batch that is not full.
+        :param num_workers: threads that crop and recenter segmented images.
+        :param history: number of most recent images `metrics` is computed over.
+        """
+        self.interface = interface or create_carvekit_interface()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.pool = ThreadPoolExecutor(num_workers)
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self._segment_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, image):
+        """Queue a PIL image, returns a future of its `crop_foreground` output."""
+        future = Future()
+        self.requests.put((image.convert("RGB"), future, time.perf_counter()))
+        return future
+
+    def __call__(self, image):
+        """Drop-in for `load_and_preprocess(interface, image)`."""
+        return self.submit(image).result()
+
+    def map(self, images):
+        """Preprocess many images, in order, batched with concurrent requests."""
+        futures = [self.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Finish the queued images and stop the threads. Safe to call again."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.requests.put(None)
+        self.thread.join()
+        self.pool.shutdown()
+
+    def _next_batch(self):
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self.requests.get(
+                    timeout=max(0.0, deadline - time.perf_counter())
+                )
+            except queue.Empty:
+                break
+            if item is None:
+                # finish this batch, stop afterwards
+                self.requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _segment_loop(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            try:
+                outputs = self.interface([image for image, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.perf_counter()
+            with self.lock:
+                self.batch_sizes.append(len(batch))
+            for (image, future, submitted), output in zip(batch, outputs):
+                timings = {"queue": start - submitted, "segment": end - start}
+                self.pool.submit(self._postprocess, image, output, future, timings)
+
+    def _postprocess(self, image, output, future, timings):
+        start = time.perf_counter()
+        try:
+            result = crop_foreground(image, output)
+        except Exception as e:
+            future.set_exception(e)
+            return
+        timings["postprocess"] = time.perf_counter() - start
+        timings["total"] = sum(timings.values())
+        with self.lock:
+            self.latencies.append(timings)
+        future.set_result(result)
+
+    def metrics(self):
+        """Per-image latency in ms (mean, p50, p95 per stage) and batch sizes."""
+        with self.lock:
+            latencies = list(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+        out = {"images": len(latencies)}
+        if batch_sizes:
+            out["mean_batch_size"] = float(np.mean(batch_sizes))
+        for stage in LATENCY_STAGES:
+            if not latencies:
+                break
+            ms = np.array([timings[stage] for timings in latencies]) * 1e3
+            out[f"{stage}_ms_mean"] = float(ms.mean())
+            out[f"{stage}_ms_p50"] = float(np.percentile(ms, 50))
+            out[f"{stage}_ms_p95"] = float(np.percentile(ms, 95))
+        return out
+
+
+def main(in_dir, out_dir, max_batch=5, num_workers=2):
+    """Remove the background of every image in `in_dir`, written as png."""
+    os.makedirs(out_dir, exist_ok=True)
+    names = sorted(
+        name
+        for name in os.listdir(in_dir)
+        if name.lower().endswith((".png", ".jpg", ".jpeg", ".webp"))
+    )
+    service = BackgroundRemovalService(max_batch=max_batch, num_workers=num_workers)
+    try:
+        futures = [
+            service.submit(Image.open(os.path.join(in_dir, name))) for name in names
+        ]
+        for name, future in zip(names, futures):
+            path = os.path.join(out_dir, os.path.splitext(name)[0] + ".png")
+            Image.fromarray(future.result()).save(path)
+    finally:
+        service.close()
+    print(service.metrics())
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,388 @@
+"""Sharded checkpoints written in the background.
+
+`ShardedCheckpointWriter.save` splits a Lightning checkpoint into its tensors
+and a skeleton holding everything else. The tensors are spread over the ranks
+by size, so every rank copies only its share into pinned host memory. Each rank
+then writes its shard from a background thread while training continues. Rank
+zero also writes the skeleton, waits for the shards of all ranks and commits
+the checkpoint by atomically renaming `manifest.json` into place. A directory
+without a manifest is an incomplete checkpoint. All ranks need to see the same
+`dirpath`.
+
+    <dirpath>/step-000005000/
+        manifest.json
+        skeleton.pt
+        shard-00000-of-00008.pt
+        ...
+
+`merge` turns such a directory back into a regular `.ckpt` for
+`--resume_from_checkpoint`. `export_inference` writes only the EMA weights of
+the UNet and `cc_projection`, which is all that sampling needs besides the
+pretrained VAE and CLIP.
+
+For inference, `slim` converts a training checkpoint into the EMA weights of
+the whole model without the training state, optionally in fp16. `load_model`
+loads either kind: it memory-maps the file, creates the parameters on the
+meta device and assigns the mapped tensors to them, so neither a random init
+nor a second copy of the weights is ever held in host memory (torch >= 2.1,
+older versions fall back to a regular load).
+
+Usage:
+    python -m ldm.checkpoint merge logs/.../checkpoints/sharded/step-000005000 \
+        merged.ckpt
+    python -m ldm.checkpoint slim 105000.ckpt 105000-slim.ckpt --half
+"""
+
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import fire
+import torch
+import torch.nn as nn
+from ldm.util import instantiate_from_config
+from omegaconf import OmegaConf
+
+MANIFEST_NAME = "manifest.json"
+SKELETON_NAME = "skeleton.pt"
+INFERENCE_PREFIXES = ("model.diffusion_model.", "cc_projection.")
+# placeholder key of the tensor references in the skeleton, plain data so
+# that the references need no class of this module to unpickle
+TENSOR_REF = "__tensor_ref__"
+MMAP_LOAD = "mmap" in inspect.signature(torch.load).parameters
+WEIGHTS_ONLY_LOAD = "weights_only" in inspect.signature(torch.load).parameters
+ASSIGN_LOAD = "assign" in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+def load_trusted(path, **kwargs):
+    """`torch.load` of a full Lightning checkpoint written by this code base.
+
+    These hold more than tensors (e.g. the callback states are keyed by their
+    class), which torch >= 2.6 refuses to unpickle by default.
+    """
+    if WEIGHTS_ONLY_LOAD:
+        kwargs["weights_only"] = False
+    return torch.load(path, **kwargs)
+
+
+def split_tensors(obj, tensors):
+    """Replace every tensor in a nested checkpoint by `{TENSOR_REF: index}`."""
+    if isinstance(obj, torch.Tensor):
+        tensors.append(obj)
+        return {TENSOR_REF: len(tensors) - 1}
+    if isinstance(obj, dict):
+        return type(obj)((k, split_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(split_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def join_tensors(obj, tensors):
+    if isinstance(obj, dict) and list(obj) == [TENSOR_REF]:
+        return tensors[obj[TENSOR_REF]]
+    if isinstance(obj, dict):
+        return type(obj)((k, join_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(join_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def assign_shards(tensors, world_size):
+    """Greedily balance the bytes of `tensors` over `world_size` shards.
+
+    Deterministic, so every rank computes the same assignment.
+    """
+    order = sorted(
+        range(len(tensors)),
+        key=lambda i: (-tensors[i].numel() * tensors[i].element_size(), i),
+    )
+    loads = [0] * world_size
+    owner = [0] * len(tensors)
+    for i in order:
+        rank = loads.index(min(loads))
+        owner[i] = rank
+        loads[rank] += tensors[i].numel() * tensors[i].element_size()
+    return owner
+
+
+def atomic_save(obj, path):
+    tmp = path + ".tmp"
+    torch.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+def shard_name(rank, world_size):
+    return f"shard-{rank:05d}-of-{world_size:05d}.pt"
+
+
+class ShardedCheckpointWriter:
+    """Copies checkpoints to pinned host memory and writes them in a thread.
+
+    The pinned buffers are kept between saves. A save waits for the previous
+    write to finish before reusing them.
+    """
+
+    def __init__(self, rank=0, world_size=1, manifest_timeout=3600):
+        self.rank = rank
+        self.world_size = world_size
+        self.manifest_timeout = manifest_timeout
+        self.host_buffers = {}
+        self.thread = None
+
+    def to_host(self, key, tensor):
+        tensor = tensor.detach()
+        buffer = self.host_buffers.get(key)
+        if (
+            buffer is None
+            or buffer.shape != tensor.shape
+            or buffer.dtype != tensor.dtype
+        ):
+            buffer = torch.empty(
+                tensor.shape,
+                dtype=tensor.dtype,
+                pin_memory=torch.cuda.is_available(),
+            )
+            self.host_buffers[key] = buffer
+        return buffer.copy_(tensor, non_blocking=True)
+
+    def save(self, checkpoint, dirpath, step, inference_model=None):
+        """Snapshot `checkpoint` and write it to `dirpath/step-<step>`.
+
+        :param inference_model: if given, the EMA weights of its UNet and
+            `cc_projection` are also written as
+            `<dirpath>/inference-step-<step>.ckpt`. Only pass it on rank zero.
+        """
+        self.wait()
+        tensors = []
+        skeleton = split_tensors(checkpoint, tensors)
+        owner = assign_shards(tensors, self.world_size)
+        shard = {
+            i: self.to_host(("ckpt", i), t)
+            for i, t in enumerate(tensors)
+            if owner[i] == self.rank
+        }
+        inference = None
+        if inference_model is not None:
+            # the copies are queued before ema_scope restores the weights
+            with inference_model.ema_scope():
+                inference = {
+                    k: self.to_host(("inference", k), v)
+                    for k, v in inference_model.state_dict().items()
+                    if k.startswith(INFERENCE_PREFIXES)
+                }
+        # the copies into pinned memory are asynchronous
+        if torch.cuda.is_available():
+            torch.cuda.current_stream().synchronize()
+
+        self.thread = threading.Thread(
+            target=self._write,
+            args=(skeleton, shard, dirpath, step, len(tensors), inference),
+            daemon=True,
+        )
+        self.thread.start()
+
+    def _write(self, skeleton, shard, dirpath, step, num_tensors, inference):
+        start = time.time()
+        ckpt_dir = os.path.join(dirpath, f"step-{step:09d}")
+        os.makedirs(ckpt_dir, exist_ok=True)
+        shard_path = os.path.join(ckpt_dir, shard_name(self.rank, self.world_size))
+        atomic_save(shard, shard_path)
+        if self.rank != 0:
+            return
+
+        atomic_save(skeleton, os.path.join(ckpt_dir, SKELETON_NAME))
+        if inference is not None:
+            atomic_save(
+                {"global_step": step, "state_dict": inference},
+                os.path.join(dirpath, f"inference-step-{step:09d}.ckpt"),
+            )
+        shards = [shard_name(r, self.world_size) for r in range(self.world_size)]
+        while not all(os.path.exists(os.path.join(ckpt_dir, s)) for s in shards):
+            if time.time() - start > self.manifest_timeout:
+                print(f"Sharded checkpoint {ckpt_dir} incomplete, not committed")
+                return
+            time.sleep(1.0)
+        manifest = {
+            "global_step": step,
+            "world_size": self.world_size,
+            "num_tensors": num_tensors,
+            "skeleton": SKELETON_NAME,
+            "shards": shards,
+        }
+        path = os.path.join(ckpt_dir, MANIFEST_NAME)
+        with open(path + ".tmp", "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(path + ".tmp", path)
+        print(f"Committed checkpoint {ckpt_dir} in {time.time() - start:.1f}s")
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def load_sharded_checkpoint(ckpt_dir, map_location="cpu"):
+    """Reassemble the checkpoint of a committed sharded checkpoint directory."""
+    manifest_path = os.path.join(ckpt_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        raise FileNotFoundError(f"{ckpt_dir} has no manifest, it is incomplete")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    tensors = [None] * manifest["num_tensors"]
+    for name in manifest["shards"]:
+        shard = torch.load(os.path.join(ckpt_dir, name), map_location=map_location)
+        for i, tensor in shard.items():
+            tensors[i] = tensor
+    skeleton = load_trusted(
+        os.path.join(ckpt_dir, manifest["skeleton"]), map_location=map_location
+    )
+    return join_tensors(skeleton, tensors)
+
+
+def merge(ckpt_dir, out_path):
+    """Write the sharded checkpoint `ckpt_dir` as a single Lightning checkpoint."""
+    torch.save(load_sharded_checkpoint(ckpt_dir), out_path)
+    print(f"Wrote {out_path}")
+
+
+def load_checkpoint(ckpt):
+    """Load a checkpoint file or sharded checkpoint directory to the CPU.
+
+    Files are memory-mapped where supported, so only the tensors that are
+    actually used are read from disk.
+    """
+    if os.path.isdir(ckpt):
+        return load_sharded_checkpoint(ckpt)
+    if MMAP_LOAD:
+        try:
+            return load_trusted(ckpt, map_location="cpu", mmap=True)
+        except RuntimeError:
+            # checkpoints in the legacy (non zip) format can not be mapped
+            pass
+    return load_trusted(ckpt, map_location="cpu")
+
+
+def ema_state_dict(sd):
+    """The model weights of `sd` with the EMA weights in place of the
+    trained ones and without the `model_ema.*` copy."""
+    state_dict = {}
+    for k, v in sd.items():
+        if k.startswith("model_ema."):
+            continue
+        if k.startswith("model."):
+            # LitEma stores "model.a.b" as "model_ema.ab"
+            v = sd.get("model_ema." + k[len("model.") :].replace(".", ""), v)
+        state_dict[k] = v
+    return state_dict
+
+
+def export_inference(ckpt, out_path):
+    """Write the inference weights of a regular or sharded checkpoint.
+
+    The EMA weights are read from the `model_ema.*` entries of the checkpoint
+    where present, so no model has to be instantiated.
+    """
+    pl_sd = load_checkpoint(ckpt)
+    state_dict = {
+        k: v
+        for k, v in ema_state_dict(pl_sd["state_dict"]).items()
+        if k.startswith(INFERENCE_PREFIXES)
+    }
+    torch.save(
+        {"global_step": pl_sd["global_step"], "state_dict": state_dict}, out_path
+    )
+    print(f"Wrote {len(state_dict)} tensors to {out_path}")
+
+
+def slim(ckpt, out_path, half=False):
+    """Write the EMA weights of every submodule of a training checkpoint.
+
+    :param half: store the module weights in fp16. The top-level buffers of
+        the noise schedule stay in fp32. `load_model` upcasts the weights to
+        the dtype of the model again, so this halves the file, not the memory.
+    """
+    pl_sd = load_checkpoint(ckpt)
+    state_dict = ema_state_dict(pl_sd["state_dict"])
+    if half:
+        state_dict = {
+            k: v.half() if "." in k and v.is_floating_point() else v
+            for k, v in state_dict.items()
+        }
+    torch.save(
+        {"global_step": pl_sd.get("global_step"), "state_dict": state_dict}, out_path
+    )
+    print(f"Wrote {len(state_dict)} tensors to {out_path}")
+
+
+@contextmanager
+def empty_parameters():
+    """Create the parameters of all modules built inside on the meta device.
+
+    Buffers are still created normally, since the non-persistent ones are not
+    part of any checkpoint.
+    """
+    register_parameter = nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        if param is not None and not param.is_meta:
+            param = nn.Parameter(param.to("meta"), requires_grad=param.requires_grad)
+        register_parameter(module, name, param)
+
+    nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        nn.Module.register_parameter = register_parameter
+
+
+def load_model(config, ckpt, device="cpu", verbose=False):
+    """Instantiate `config.model` with the EMA weights of `ckpt` for inference.
+
+    `ckpt` can be a training checkpoint, a sharded checkpoint directory or the
+    output of `slim`. The EMA weights are loaded into the model directly, so
+    the returned model has `use_ema=False` and its ema_scope is a no-op.
+    Floating point weights are cast to the dtype of the model, so fp16
+    checkpoints work with fp32 inputs.
+    """
+    print(f"Loading model from {ckpt}")
+    pl_sd = load_checkpoint(ckpt)
+    if pl_sd.get("global_step") is not None:
+        print(f"Global Step: {pl_sd['global_step']}")
+    sd = ema_state_dict(pl_sd["state_dict"])
+    model_config = OmegaConf.merge(config.model, {"params": {"use_ema": False}})
+
+    if ASSIGN_LOAD:
+        with empty_parameters():
+            model = instantiate_from_config(model_config)
+        # assign keeps the dtype of the checkpoint, unlike a copying load
+        targets = dict(model.named_parameters())
+        targets.update(model.named_buffers())
+        for k, v in sd.items():
+            target = targets.get(k)
+            if target is not None and v.is_floating_point():
+                if target.is_floating_point():
+                    sd[k] = v.to(target.dtype)
+        m, u = model.load_state_dict(sd, strict=False, assign=True)
+        empty = [name for name, p in model.named_parameters() if p.is_meta]
+        if empty:
+            raise RuntimeError(f"{ckpt} has no weights for {empty}")
+    else:
+        model = instantiate_from_config(model_config)
+        m, u = model.load_state_dict(sd, strict=False)
+    if len(m) > 0 and verbose:
+        print("missing keys:")
+        print(m)
+    if len(u) > 0 and verbose:
+        print("unexpected keys:")
+        print(u)
+
+    model.to(device)
+    model.eval()
+    return model
+
+
+if __name__ == "__main__":
+    fire.Fire({"merge": merge, "export_inference": export_inference, "slim": slim})
@@ -0,0 +1,123 @@
+"""Offline cache of the frozen-encoder outputs for the Objaverse views.
+
+The VAE encoder and the CLIP image encoder of `LatentDiffusion` are frozen, so
+their outputs for the `total_view` renders of an object never change. `precompute`
+runs both encoders once per view and writes `<uid>.npz` holding
+
+    moments: [total_view, 2 * z_channels, h, w] VAE posterior parameters
+    clip:    [total_view, 1, 768] CLIP image embeddings
+
+Once all ranks are done, `index` writes `clean_paths.json` listing the objects
+whose latents were written. `ObjaverseData(latent_dir=..., clean_index=...)`
+then yields these instead of the images and `LatentDiffusion.get_input` skips
+both encoders.
+
+Usage (one process per GPU):
+    python -m ldm.data.objaverse_latents precompute \
+        --config configs/sd-objaverse-finetune-c_concat-256.yaml \
+        --ckpt 105000.ckpt --root_dir views_whole_sphere --paths_dir . \
+        --out_dir views_latents --rank 0 --world_size 8
+    python -m ldm.data.objaverse_latents index --paths_dir . \
+        --out_dir views_latents --clean_index clean_paths.json
+"""
+
+import json
+import os
+
+import fire
+import numpy as np
+import torch
+from einops import rearrange
+from ldm.data.simple import ObjaverseData
+from ldm.extras import load_model_from_config
+from torchvision import transforms
+from tqdm import tqdm
+
+
+@torch.no_grad()
+def precompute(
+    config,
+    ckpt,
+    root_dir,
+    paths_dir,
+    out_dir,
+    total_view=12,
+    image_size=256,
+    shard_dir=None,
+    device="cuda",
+    dtype="float16",
+    rank=0,
+    world_size=1,
+    overwrite=False,
+):
+    """Encode every view of every object listed in `valid_paths.json`.
+
+    Objects are split round-robin over `world_size` ranks so the job can be
+    launched once per GPU. Already cached objects are skipped unless
+    `overwrite` is set.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    model = load_model_from_config(config, ckpt, device)
+    image_transforms = transforms.Compose(
+        [
+            transforms.Resize(image_size),
+            transforms.ToTensor(),
+            transforms.Lambda(lambda x: rearrange(x * 2.0 - 1.0, "c h w -> h w c")),
+        ]
+    )
+    color = [1.0, 1.0, 1.0, 1.0]
+
+    for validation in (False, True):
+        dataset = ObjaverseData(
+            root_dir=root_dir,
+            paths_dir=paths_dir,
+            image_transforms=image_transforms,
+            total_view=total_view,
+            validation=validation,
+            shard_dir=shard_dir,
+        )
+        for uid in tqdm(dataset.paths[rank::world_size], desc="Encoding objects"):
+            path = os.path.join(out_dir, uid + ".npz")
+            if os.path.exists(path) and not overwrite:
+                continue
+            try:
+                ims = torch.stack(
+                    [
+                        dataset.process_im(dataset.load_view(uid, view, color))
+                        for view in range(total_view)
+                    ]
+                )
+            except Exception as e:
+                print(f"Skipping {uid}: {e}")
+                continue
+            x = rearrange(ims, "b h w c -> b c h w").to(device)
+            moments = model.encode_first_stage(x).parameters
+            clip_emb = model.get_learned_conditioning(x)
+            np.savez(
+                path,
+                moments=moments.cpu().numpy().astype(dtype),
+                clip=clip_emb.cpu().numpy().astype(dtype),
+            )
+
+
+def index(paths_dir, out_dir, clean_index=None):
+    """Write `<out_dir>/clean_paths.json`, the objects of `valid_paths.json`
+    (and of `clean_index`, if given) whose latents are cached in `out_dir`.
+    """
+    with open(os.path.join(paths_dir, "valid_paths.json")) as f:
+        paths = json.load(f)
+    if clean_index is not None:
+        with open(clean_index) as f:
+            clean = set(json.load(f))
+        paths = [path for path in paths if path in clean]
+    cached = set(
+        name[: -len(".npz")] for name in os.listdir(out_dir) if name.endswith(".npz")
+    )
+    paths = [path for path in paths if path in cached]
+    with open(os.path.join(out_dir, "clean_paths.json"), "w") as f:
+        json.dump(paths, f)
+    print(f"{len(paths)} objects with cached latents")
+
+
+if __name__ == "__main__":
+    fire.Fire({"precompute": precompute, "index": index})
@@ -0,0 +1,95 @@
+"""Relative camera poses of the Objaverse views.
+
+`relative_pose_table` turns the `[V, 3, 4]` world-to-camera matrices of an
+object into the `[V, V, 4]` table of (d_theta, sin(d_azimuth), cos(d_azimuth),
+d_z) conditioning vectors used by zero123, where entry `[target, cond]` is the
+pose of the target view relative to the conditioning view.
+
+`build` writes one table per object into a single memory-mappable
+`pose_table.npy` (next to `pose_uids.json`) so that `ObjaverseData(pose_dir=...)`
+no longer reads any `.npy` file during training.
+
+Usage:
+    python -m ldm.data.objaverse_poses \
+        --root_dir views_whole_sphere --paths_dir . --out_dir views_poses
+"""
+
+import json
+import os
+
+import fire
+import numpy as np
+from tqdm import tqdm
+
+TABLE_NAME = "pose_table.npy"
+UIDS_NAME = "pose_uids.json"
+
+
+def camera_spherical(RTs):
+    """Return the (theta, azimuth, radius) of the camera centers of `[V, 3, 4]` RTs.
+    theta is the elevation angle defined from the Z-axis down.
+    """
+    R, T = RTs[:, :3, :3], RTs[:, :, -1]
+    xyz = -np.einsum("vji,vj->vi", R, T)
+    xy = xyz[:, 0] ** 2 + xyz[:, 1] ** 2
+    z = np.sqrt(xy + xyz[:, 2] ** 2)
+    theta = np.arctan2(np.sqrt(xy), xyz[:, 2])
+    azimuth = np.arctan2(xyz[:, 1], xyz[:, 0])
+    return theta, azimuth, z
+
+
+def relative_pose_table(RTs):
+    """Return the `[V, V, 4]` float32 relative pose table of `[V, 3, 4]` RTs."""
+    theta, azimuth, z = camera_spherical(np.asarray(RTs, dtype=np.float64))
+    d_theta = theta[:, None] - theta[None, :]
+    d_azimuth = (azimuth[:, None] - azimuth[None, :]) % (2 * np.pi)
+    d_z = z[:, None] - z[None, :]
+    return np.stack(
+        [d_theta, np.sin(d_azimuth), np.cos(d_azimuth), d_z], axis=-1
+    ).astype(np.float32)
+
+
+def load_pose_index(pose_dir):
+    """Return the memory-mapped `[N, V, V, 4]` table and a uid -> row mapping."""
+    table = np.load(os.path.join(pose_dir, TABLE_NAME), mmap_mode="r")
+    with open(os.path.join(pose_dir, UIDS_NAME)) as f:
+        uids = json.load(f)
+    return table, {uid: row for row, uid in enumerate(uids)}
+
+
+def build(root_dir, paths_dir, out_dir, total_view=12, shard_dir=None):
+    """Build the shared pose index for every object in `valid_paths.json`.
+
+    Poses are read from `root_dir` or, if given, from the packed shards of
+    ldm.data.objaverse_shards. Objects with unreadable poses are left out.
+    """
+    from ldm.data.objaverse_shards import ObjaverseShardReader
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(paths_dir, "valid_paths.json")) as f:
+        paths = json.load(f)
+    reader = ObjaverseShardReader(shard_dir) if shard_dir is not None else None
+
+    uids, tables = [], []
+    for uid in tqdm(paths, desc="Building pose tables"):
+        try:
+            if reader is not None:
+                RTs = [reader.read_pose(uid, view) for view in range(total_view)]
+            else:
+                RTs = [
+                    np.load(os.path.join(root_dir, uid, "%03d.npy" % view))
+                    for view in range(total_view)
+                ]
+        except (OSError, KeyError, ValueError):
+            continue
+        uids.append(uid)
+        tables.append(relative_pose_table(np.stack(RTs)))
+
+    np.save(os.path.join(out_dir, TABLE_NAME), np.stack(tables))
+    with open(os.path.join(out_dir, UIDS_NAME), "w") as f:
+        json.dump(uids, f)
+    print(f"Wrote pose tables of {len(uids)}/{len(paths)} objects to {out_dir}")
+
+
+if __name__ == "__main__":
+    fire.Fire(build)
@@ -0,0 +1,163 @@
+"""Packed shard format for the Objaverse multi-view renders.
+
+Every object directory of the renders holds `total_view` pairs of
+`NNN.png` / `NNN.npy` files. Reading them one by one costs two `open` calls
+per view, which a shared filesystem does not keep up with. `pack` concatenates
+the raw bytes of all files into a few large `shard_XXXXX.bin` files and writes
+an `index.npz` with the byte offsets, so that `ObjaverseShardReader` can serve
+any view through a memory-mapped slice.
+
+Usage:
+    python -m ldm.data.objaverse_shards pack \
+        --root_dir views_whole_sphere --paths_dir . --out_dir views_shards
+"""
+
+import io
+import json
+import os
+
+import fire
+import numpy as np
+from tqdm import tqdm
+
+INDEX_NAME = "index.npz"
+SHARD_NAME = "shard_{:05d}.bin"
+
+
+def _read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def pack(
+    root_dir,
+    paths_dir,
+    out_dir,
+    total_view=12,
+    shard_size_gb=8.0,
+    skip_missing=True,
+):
+    """Pack the views listed in `paths_dir/valid_paths.json` into shards.
+
+    :param root_dir: directory holding one sub-directory of renders per object.
+    :param paths_dir: directory containing `valid_paths.json`.
+    :param out_dir: output directory for the shards and the index.
+    :param total_view: number of rendered views per object.
+    :param shard_size_gb: a new shard is started once this size is exceeded.
+    :param skip_missing: leave objects with unreadable files out of the index
+        instead of raising.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(paths_dir, "valid_paths.json")) as f:
+        paths = json.load(f)
+
+    shard_size = int(shard_size_gb * 2**30)
+    uids, shard_ids, offsets = [], [], []
+    shard_id, shard_pos = 0, 0
+    shard = open(os.path.join(out_dir, SHARD_NAME.format(shard_id)), "wb")
+    skipped = 0
+    try:
+        for uid in tqdm(paths, desc="Packing objects"):
+            filename = os.path.join(root_dir, uid)
+            try:
+                blobs = []
+                for view in range(total_view):
+                    blobs.append(
+                        _read_bytes(os.path.join(filename, "%03d.png" % view))
+                    )
+                    blobs.append(
+                        _read_bytes(os.path.join(filename, "%03d.npy" % view))
+                    )
+            except OSError:
+                if not skip_missing:
+                    raise
+                skipped += 1
+                continue
+
+            if shard_pos > 0 and shard_pos + sum(map(len, blobs)) > shard_size:
+                shard.close()
+                shard_id += 1
+                shard_pos = 0
+                shard = open(os.path.join(out_dir, SHARD_NAME.format(shard_id)), "wb")
+
+            # [total_view, 2 (png, npy), 2 (offset, length)]
+            object_offsets = np.zeros((total_view, 2, 2), dtype=np.int64)
+            for i, blob in enumerate(blobs):
+                object_offsets[i // 2, i % 2] = (shard_pos, len(blob))
+                shard.write(blob)
+                shard_pos += len(blob)
+
+            uids.append(uid)
+            shard_ids.append(shard_id)
+            offsets.append(object_offsets)
+    finally:
+        shard.close()
+
+    np.savez(
+        os.path.join(out_dir, INDEX_NAME),
+        uids=np.array(uids),
+        shard_ids=np.array(shard_ids, dtype=np.int32),
+        offsets=np.stack(offsets) if offsets else np.zeros((0, total_view, 2, 2)),
+        shard_names=np.array(
+            [SHARD_NAME.format(i) for i in range(shard_id + 1)]
+        ),
+    )
+    print(
+        f"Packed {len(uids)} objects into {shard_id + 1} shards in {out_dir} "
+        f"({skipped} skipped)"
+    )
+
+
+class ObjaverseShardReader(object):
+    """Random access to the views of a packed shard directory.
+
+    Shards are memory-mapped lazily and re-mapped after a fork, so a reader
+    created in the main process can be handed to dataloader workers.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        index = np.load(os.path.join(shard_dir, INDEX_NAME))
+        self.uids = index["uids"].tolist()
+        self.shard_ids = index["shard_ids"]
+        self.offsets = index["offsets"]
+        self.shard_names = index["shard_names"].tolist()
+        self.uid_to_row = {uid: row for row, uid in enumerate(self.uids)}
+        self.total_view = self.offsets.shape[1]
+        self._shards = {}
+        self._pid = None
+
+    def __contains__(self, uid):
+        return uid in self.uid_to_row
+
+    def __len__(self):
+        return len(self.uids)
+
+    def _shard(self, shard_id):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._shards = {}
+        if shard_id not in self._shards:
+            self._shards[shard_id] = np.memmap(
+                os.path.join(self.shard_dir, self.shard_names[shard_id]),
+                dtype=np.uint8,
+                mode="r",
+            )
+        return self._shards[shard_id]
+
+    def _read(self, uid, view, kind):
+        row = self.uid_to_row[uid]
+        offset, length = self.offsets[row, view, kind]
+        return self._shard(self.shard_ids[row])[offset : offset + length]
+
+    def read_png(self, uid, view):
+        """Return a file-like object with the encoded PNG of a view."""
+        return io.BytesIO(self._read(uid, view, 0).tobytes())
+
+    def read_pose(self, uid, view):
+        """Return the 3x4 camera matrix of a view."""
+        return np.load(io.BytesIO(self._read(uid, view, 1).tobytes()))
+
+
+if __name__ == "__main__":
+    fire.Fire({"pack": pack})
@@ -0,0 +1,116 @@
+"""Parallel validator for the Objaverse multi-view renders.
+
+`validate` reads every PNG / NPY pair of every object in `valid_paths.json`
+with a pool of worker processes and writes
+
+    clean_paths.json: the readable objects, in the order of valid_paths.json
+    quarantine.json:  {uid: reason} for every object that failed
+
+`ObjaverseData(clean_index=".../clean_paths.json")` then only serves objects
+from the clean index instead of substituting a fallback object at train time.
+
+Usage:
+    python -m ldm.data.objaverse_validate \
+        --root_dir views_whole_sphere --paths_dir . --out_dir .
+"""
+
+import json
+import os
+from multiprocessing import Pool
+
+import fire
+import matplotlib.pyplot as plt
+import numpy as np
+from ldm.data.objaverse_shards import ObjaverseShardReader
+from tqdm import tqdm
+
+CLEAN_NAME = "clean_paths.json"
+QUARANTINE_NAME = "quarantine.json"
+
+_worker = {}
+
+
+def _init_worker(root_dir, total_view, shard_dir, latent_dir):
+    _worker["root_dir"] = root_dir
+    _worker["total_view"] = total_view
+    _worker["reader"] = (
+        ObjaverseShardReader(shard_dir) if shard_dir is not None else None
+    )
+    _worker["latent_dir"] = latent_dir
+
+
+def check_object(uid):
+    """Return `(uid, None)` if every view of `uid` is readable, else `(uid, reason)`."""
+    reader = _worker["reader"]
+    try:
+        if reader is not None and uid not in reader:
+            raise KeyError("not in shard index")
+        for view in range(_worker["total_view"]):
+            if reader is not None:
+                img = plt.imread(reader.read_png(uid, view), format="png")
+                RT = reader.read_pose(uid, view)
+            else:
+                filename = os.path.join(_worker["root_dir"], uid)
+                img = plt.imread(os.path.join(filename, "%03d.png" % view))
+                RT = np.load(os.path.join(filename, "%03d.npy" % view))
+            if img.ndim != 3 or img.shape[-1] != 4:
+                raise ValueError(f"view {view}: expected RGBA, got {img.shape}")
+            if RT.shape != (3, 4) or not np.isfinite(RT).all():
+                raise ValueError(f"view {view}: invalid camera matrix")
+        if _worker["latent_dir"] is not None:
+            path = os.path.join(_worker["latent_dir"], uid + ".npz")
+            if not os.path.exists(path):
+                raise FileNotFoundError("missing cached latents")
+    except Exception as e:
+        return uid, f"{type(e).__name__}: {e}"
+    return uid, None
+
+
+def validate(
+    root_dir,
+    paths_dir,
+    out_dir,
+    total_view=12,
+    shard_dir=None,
+    latent_dir=None,
+    num_workers=None,
+    chunksize=64,
+):
+    """Check every object of `paths_dir/valid_paths.json` in parallel.
+
+    :param shard_dir: read the views from packed shards instead of `root_dir`.
+    :param latent_dir: also require the cached latents of
+        ldm.data.objaverse_latents to exist.
+    :param num_workers: number of processes, defaults to `os.cpu_count()`.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(paths_dir, "valid_paths.json")) as f:
+        paths = json.load(f)
+
+    quarantine = {}
+    with Pool(
+        num_workers,
+        initializer=_init_worker,
+        initargs=(root_dir, total_view, shard_dir, latent_dir),
+    ) as pool:
+        for uid, reason in tqdm(
+            pool.imap_unordered(check_object, paths, chunksize=chunksize),
+            total=len(paths),
+            desc="Validating objects",
+        ):
+            if reason is not None:
+                quarantine[uid] = reason
+
+    clean = [uid for uid in paths if uid not in quarantine]
+    with open(os.path.join(out_dir, CLEAN_NAME), "w") as f:
+        json.dump(clean, f)
+    with open(os.path.join(out_dir, QUARANTINE_NAME), "w") as f:
+        json.dump(quarantine, f, indent=2)
+    print(
+        f"{len(clean)}/{len(paths)} objects are clean, "
+        f"{len(quarantine)} quarantined in {out_dir}"
+    )
+
+
+if __name__ == "__main__":
+    fire.Fire(validate)
@@ -5,6 +5,7 @@ import math
 import os
 import random
 import sys
+from collections import OrderedDict
 from pathlib import Path
 from typing import Dict
 
@@ -13,15 +14,18 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pytorch_lightning as pl
 import torch
+import torch.distributed as dist
 import torchvision
 import webdataset as wds
 from datasets import load_dataset
 from einops import rearrange
+from ldm.data.objaverse_poses import load_pose_index, relative_pose_table
+from ldm.data.objaverse_shards import ObjaverseShardReader
 from ldm.util import instantiate_from_config
 from omegaconf import DictConfig, ListConfig
 from PIL import Image
 from torch.nn.utils.rnn import pad_packed_sequence
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 from torch.utils.data.distributed import DistributedSampler
 from torchvision import transforms
 
@@ -186,11 +190,16 @@ class NfpDataset(Dataset):
 
 
 def multiview_collate(batch):
+    if isinstance(batch[0], list):
+        # ObjaverseData(tuples_per_object=K) yields K tuples per item
+        batch = [sample for samples in batch for sample in samples]
     batch_repacked = dict()
-    batch_repacked["image_cond"] = torch.cat([sample["image_cond"] for sample in batch])
-    batch_repacked["image_target"] = torch.stack(
-        [sample["image_target"] for sample in batch]
-    )
+    for key in ["image_cond", "latent_cond", "clip_cond"]:
+        if key in batch[0]:
+            batch_repacked[key] = torch.cat([sample[key] for sample in batch])
+    for key in ["image_target", "latent_target"]:
+        if key in batch[0]:
+            batch_repacked[key] = torch.stack([sample[key] for sample in batch])
     batch_repacked["cond_count"] = torch.Tensor(
         [sample["cond_count"] for sample in batch]
     ).int()
@@ -200,6 +209,143 @@ def multiview_collate(batch):
     return batch_repacked
 
 
+class CondViewBatchSampler(Sampler):
+    """Pack samples into batches of at most `cond_view_budget` conditioning views.
+
+    The UNet runs on `sum(cond_counts)` inputs per step, so batches of a fixed
+    number of samples swing between `B` and `max_cond_count * B`. This sampler
+    draws the cond_count of every sample itself, yields `(index, cond_count)`
+    pairs for ObjaverseData (a list of K cond_counts per index with
+    `tuples_per_object=K`) and closes a batch once the next sample would not
+    fit into the budget.
+
+    Follows DistributedSampler semantics: every rank builds the same batches
+    from `seed + epoch` and takes every `num_replicas`-th one, so all ranks run
+    the same number of steps. The epoch only changes through `set_epoch`, so
+    extra passes (e.g. a `len()` or a debug iteration) do not shift the
+    shuffle; `main.CondViewBatchCallback` calls it at the start of every
+    training epoch and logs `waste_stats`. Under DDP, set
+    `replace_sampler_ddp: False` in the trainer config so that Lightning keeps
+    this sampler, which the callback checks at setup.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        cond_view_budget,
+        min_cond_count=1,
+        max_cond_count=6,
+        num_replicas=None,
+        rank=None,
+        shuffle=True,
+        seed=0,
+        drop_last=False,
+    ):
+        if num_replicas is None or rank is None:
+            distributed = dist.is_available() and dist.is_initialized()
+            if num_replicas is None:
+                num_replicas = dist.get_world_size() if distributed else 1
+            if rank is None:
+                rank = dist.get_rank() if distributed else 0
+        # ObjaverseData(tuples_per_object=K) takes K cond_counts per item
+        self.tuples_per_object = dataset.tuples_per_object
+        if cond_view_budget < max_cond_count * self.tuples_per_object:
+            raise ValueError(
+                f"cond_view_budget ({cond_view_budget}) must be at least "
+                f"max_cond_count * tuples_per_object "
+                f"({max_cond_count * self.tuples_per_object})"
+            )
+        self.num_samples = len(dataset)
+        self.cond_view_budget = cond_view_budget
+        self.min_cond_count = min_cond_count
+        self.max_cond_count = max_cond_count
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches = None
+        self._dropped_samples = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def make_batches(self):
+        """Return the batches of all ranks for the current epoch."""
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            order = torch.randperm(self.num_samples, generator=g).tolist()
+        else:
+            order = list(range(self.num_samples))
+        cond_counts = torch.randint(
+            self.min_cond_count,
+            self.max_cond_count + 1,
+            (self.num_samples, self.tuples_per_object),
+            generator=g,
+        ).tolist()
+
+        batches, batch, cond_views = [], [], 0
+        for index, item_cond_counts in zip(order, cond_counts):
+            if self.tuples_per_object == 1:
+                item_cond_counts = item_cond_counts[0]
+            item_cond_views = self._cond_views(item_cond_counts)
+            if cond_views + item_cond_views > self.cond_view_budget:
+                batches.append(batch)
+                batch, cond_views = [], 0
+            batch.append((index, item_cond_counts))
+            cond_views += item_cond_views
+        if batch and not self.drop_last:
+            batches.append(batch)
+        # every rank has to run the same number of steps
+        return batches[: len(batches) - len(batches) % self.num_replicas]
+
+    def _cond_views(self, cond_counts):
+        if isinstance(cond_counts, list):
+            return sum(cond_counts)
+        return cond_counts
+
+    def _rank_batches(self):
+        if self._batches is None:
+            batches = self.make_batches()
+            self._dropped_samples = self.num_samples - sum(len(b) for b in batches)
+            self._batches = batches[self.rank :: self.num_replicas]
+        return self._batches
+
+    def waste_stats(self, batches=None):
+        """Return how well `batches` (default: this rank's) fill the budget."""
+        stats = {}
+        if batches is None:
+            batches = self._rank_batches()
+            stats["dropped_samples"] = self._dropped_samples
+        cond_views = [
+            sum(self._cond_views(cond_counts) for _, cond_counts in b)
+            for b in batches
+        ]
+        budget_views = self.cond_view_budget * len(batches)
+        stats.update(
+            {
+                "batches": len(batches),
+                "samples": sum(len(b) for b in batches),
+                "cond_views": sum(cond_views),
+                "wasted_views": budget_views - sum(cond_views),
+                "fill": sum(cond_views) / max(budget_views, 1),
+                "min_batch_views": min(cond_views, default=0),
+                "max_batch_views": max(cond_views, default=0),
+            }
+        )
+        return stats
+
+    def __iter__(self):
+        return iter(self._rank_batches())
+
+    def __len__(self):
+        return len(self._rank_batches())
+
+
 class ObjaverseDataModuleFromConfig(pl.LightningDataModule):
     def __init__(
         self,
@@ -211,11 +357,30 @@ class ObjaverseDataModuleFromConfig(pl.LightningDataModule):
         validation=None,
         test=None,
         num_workers=4,
+        shard_dir=None,
+        latent_dir=None,
+        pose_dir=None,
+        cond_view_budget=None,
+        clean_index=None,
+        uint8=False,
+        tuples_per_object=1,
+        object_cache_size=0,
         **kwargs,
     ):
         super().__init__(self)
         self.root_dir = root_dir
         self.paths_dir = paths_dir
+        self.shard_dir = shard_dir
+        self.latent_dir = latent_dir
+        self.pose_dir = pose_dir
+        self.clean_index = clean_index
+        self.uint8 = uint8
+        self.tuples_per_object = tuples_per_object
+        self.object_cache_size = object_cache_size
+        # pack training batches by number of conditioning views instead of
+        # a fixed batch_size, see CondViewBatchSampler
+        self.cond_view_budget = cond_view_budget
+        self.batch_sampler = None
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.total_view = total_view
@@ -231,12 +396,15 @@ class ObjaverseDataModuleFromConfig(pl.LightningDataModule):
             ]
         else:
             image_transforms = []
-        image_transforms.extend(
-            [
-                transforms.ToTensor(),
-                transforms.Lambda(lambda x: rearrange(x * 2.0 - 1.0, "c h w -> h w c")),
-            ]
-        )
+        if not uint8:
+            image_transforms.extend(
+                [
+                    transforms.ToTensor(),
+                    transforms.Lambda(
+                        lambda x: rearrange(x * 2.0 - 1.0, "c h w -> h w c")
+                    ),
+                ]
+            )
         self.image_transforms = torchvision.transforms.Compose(image_transforms)
 
     def train_dataloader(self):
@@ -246,7 +414,23 @@ class ObjaverseDataModuleFromConfig(pl.LightningDataModule):
             total_view=self.total_view,
             validation=False,
             image_transforms=self.image_transforms,
+            shard_dir=self.shard_dir,
+            latent_dir=self.latent_dir,
+            pose_dir=self.pose_dir,
+            clean_index=self.clean_index,
+            uint8=self.uint8,
+            tuples_per_object=self.tuples_per_object,
+            object_cache_size=self.object_cache_size,
         )
+        if self.cond_view_budget is not None:
+            # kept for main.CondViewBatchCallback, which drives its epoch
+            self.batch_sampler = CondViewBatchSampler(dataset, self.cond_view_budget)
+            return wds.WebLoader(
+                dataset,
+                batch_sampler=self.batch_sampler,
+                num_workers=self.num_workers,
+                collate_fn=multiview_collate,
+            )
         sampler = DistributedSampler(dataset)
         return wds.WebLoader(
             dataset,
@@ -264,6 +448,13 @@ class ObjaverseDataModuleFromConfig(pl.LightningDataModule):
             total_view=self.total_view,
             validation=True,
             image_transforms=self.image_transforms,
+            shard_dir=self.shard_dir,
+            latent_dir=self.latent_dir,
+            pose_dir=self.pose_dir,
+            clean_index=self.clean_index,
+            uint8=self.uint8,
+            tuples_per_object=self.tuples_per_object,
+            object_cache_size=self.object_cache_size,
         )
         sampler = DistributedSampler(dataset)
         return wds.WebLoader(
@@ -281,6 +472,13 @@ class ObjaverseDataModuleFromConfig(pl.LightningDataModule):
                 paths_dir=self.paths_dir,
                 total_view=self.total_view,
                 validation=self.validation,
+                shard_dir=self.shard_dir,
+                latent_dir=self.latent_dir,
+                pose_dir=self.pose_dir,
+                clean_index=self.clean_index,
+                uint8=self.uint8,
+                tuples_per_object=self.tuples_per_object,
+                object_cache_size=self.object_cache_size,
             ),
             batch_size=self.batch_size,
             num_workers=self.num_workers,
@@ -301,10 +499,37 @@ class ObjaverseData(Dataset):
         return_paths=False,
         total_view=12,
         validation=False,
+        shard_dir=None,
+        latent_dir=None,
+        pose_dir=None,
+        clean_index=None,
+        uint8=False,
+        tuples_per_object=1,
+        object_cache_size=0,
     ) -> None:
         """Create a dataset from a folder of images.
         If you pass in a root directory it will be searched for images
         ending in ext (ext can be a list)
+        If shard_dir is given, views are read from the packed shards written
+        by ldm.data.objaverse_shards instead of the per-view files.
+        If latent_dir is given, the VAE moments and CLIP embeddings cached by
+        ldm.data.objaverse_latents are returned instead of the images. This
+        requires a clean_index that only lists objects with cached latents,
+        e.g. the one written by ldm.data.objaverse_latents index.
+        If pose_dir is given, relative poses are looked up in the shared table
+        written by ldm.data.objaverse_poses, otherwise they are computed from
+        the two cameras of every tuple.
+        If clean_index is given, only the objects listed in it (see
+        ldm.data.objaverse_validate) are used and read errors are raised
+        instead of being replaced by a blank fallback sample.
+        If uint8 is set, images are returned as channel-first uint8 tensors
+        and image_transforms must only contain PIL transforms; the conversion
+        to [-1, 1] floats is done by DDPM.get_input on the model device.
+        If tuples_per_object > 1, every item is a list of that many independent
+        (target, conditioning views, T) tuples of the same object, decoding each
+        view at most once; multiview_collate flattens them into the batch.
+        Decoded objects are kept in a per-worker LRU of object_cache_size
+        objects.
         """
         self.root_dir = Path(root_dir)
         self.default_trans = default_trans
@@ -329,53 +554,59 @@ class ObjaverseData(Dataset):
             self.paths = self.paths[
                 : math.floor(total_objects / 100.0 * 99.0)
             ]  # used first 99% as training
+        if clean_index is not None:
+            with open(clean_index) as f:
+                clean = set(json.load(f))
+            print(
+                "============= %d objects not in clean index ============="
+                % sum(path not in clean for path in self.paths)
+            )
+            self.paths = [path for path in self.paths if path in clean]
+        self.clean_index = clean_index
+        if shard_dir is not None:
+            self.shard_reader = ObjaverseShardReader(shard_dir)
+            self.paths = [path for path in self.paths if path in self.shard_reader]
+        else:
+            self.shard_reader = None
+        if latent_dir is not None and clean_index is None:
+            # zeroed moments are no blank image and the fallback object of the
+            # image path may not be cached, so bad objects must be filtered out
+            raise ValueError("latent_dir requires a clean_index")
+        self.latent_dir = latent_dir
+        self.uint8 = uint8
+        self.tuples_per_object = tuples_per_object
+        self.object_cache_size = object_cache_size
+        self.object_cache = OrderedDict()
+        if pose_dir is not None:
+            self.pose_table, self.pose_rows = load_pose_index(pose_dir)
+        else:
+            self.pose_table, self.pose_rows = None, {}
         print("============= length of dataset %d =============" % len(self.paths))
         self.tform = image_transforms
 
     def __len__(self):
         return len(self.paths)
 
-    def cartesian_to_spherical(self, xyz):
-        ptsnew = np.hstack((xyz, np.zeros(xyz.shape)))
-        xy = xyz[:, 0] ** 2 + xyz[:, 1] ** 2
-        z = np.sqrt(xy + xyz[:, 2] ** 2)
-        theta = np.arctan2(
-            np.sqrt(xy), xyz[:, 2]
-        )  # for elevation angle defined from Z-axis down
-        # ptsnew[:,4] = np.arctan2(xyz[:,2], np.sqrt(xy)) # for elevation angle defined from XY-plane up
-        azimuth = np.arctan2(xyz[:, 1], xyz[:, 0])
-        return np.array([theta, azimuth, z])
-
     def get_T(self, target_RT, cond_RT):
-        R, T = target_RT[:3, :3], target_RT[:, -1]
-        T_target = -R.T @ T
-
-        R, T = cond_RT[:3, :3], cond_RT[:, -1]
-        T_cond = -R.T @ T
-
-        theta_cond, azimuth_cond, z_cond = self.cartesian_to_spherical(T_cond[None, :])
-        theta_target, azimuth_target, z_target = self.cartesian_to_spherical(
-            T_target[None, :]
-        )
-
-        d_theta = theta_target - theta_cond
-        d_azimuth = (azimuth_target - azimuth_cond) % (2 * math.pi)
-        d_z = z_target - z_cond
-
-        d_T = torch.tensor(
-            [
-                d_theta.item(),
-                math.sin(d_azimuth.item()),
-                math.cos(d_azimuth.item()),
-                d_z.item(),
-            ]
+        d_T = relative_pose_table(np.stack([target_RT, cond_RT]))[0, 1]
+        return torch.from_numpy(d_T)
+
+    def get_relative_pose(self, uid, index_target, index_cond):
+        if uid in self.pose_rows:
+            d_T = self.pose_table[self.pose_rows[uid], index_target, index_cond]
+            return torch.tensor(d_T)
+        # without an index only the two cameras of the pair are read
+        return self.get_T(
+            self.load_pose(uid, index_target), self.load_pose(uid, index_cond)
         )
-        return d_T
 
     def load_im(self, path, color):
         """
         replace background pixel with random color in rendering
+        path can also be a file-like object holding the encoded png
         """
+        if self.uint8:
+            return self.load_im_uint8(path, color)
         try:
             img = plt.imread(path)
         except:
@@ -387,11 +618,44 @@ class ObjaverseData(Dataset):
         img = Image.fromarray(np.uint8(img[:, :, :3] * 255.0))
         return img
 
-    def __getitem__(self, index):
+    def load_im_uint8(self, path, color):
+        img = Image.open(path)
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+        img = np.asarray(img)
+        color = np.uint8(np.asarray(color[:3]) * 255.0)
+        return Image.fromarray(np.where(img[:, :, 3:] == 0, color, img[:, :, :3]))
+
+    def load_view(self, uid, view, color):
+        if self.shard_reader is not None:
+            return self.load_im(self.shard_reader.read_png(uid, view), color)
+        return self.load_im(os.path.join(self.root_dir, uid, "%03d.png" % view), color)
 
+    def load_pose(self, uid, view):
+        if self.shard_reader is not None:
+            return self.shard_reader.read_pose(uid, view)
+        return np.load(os.path.join(self.root_dir, uid, "%03d.npy" % view))
+
+    def __getitem__(self, index):
+        if isinstance(index, (tuple, list)):
+            # drawn by CondViewBatchSampler
+            index, cond_counts = index
+        else:
+            cond_counts = [
+                random.randint(1, 6) for _ in range(self.tuples_per_object)
+            ]
+        if self.tuples_per_object == 1:
+            if isinstance(cond_counts, (tuple, list)):
+                cond_counts = cond_counts[0]
+            return self.get_tuple(index, cond_counts)
+        # independent tuples sharing the decoded views of a single object,
+        # also when the object is not kept in the LRU
+        views = self.object_views(self.paths[index])
+        return [self.get_tuple(index, cond_count, views) for cond_count in cond_counts]
+
+    def get_tuple(self, index, cond_count, views=None):
         data = {}
         total_view = self.total_view
-        cond_count = random.randint(1, 6)
         indices = random.sample(
             range(total_view), cond_count + 1
         )  # without replacement
@@ -408,78 +672,95 @@ class ObjaverseData(Dataset):
 
         color = [1.0, 1.0, 1.0, 1.0]
 
-        try:
-            # target_im = torch.stack(
-            #     [
-            #         self.process_im(
-            #             self.load_im(
-            #                 os.path.join(filename, "%03d.png" % index_target), color
-            #             )
-            #         )
-            #     ]
-            #     * cond_count
-            # )
-            target_im = self.process_im(
-                self.load_im(os.path.join(filename, "%03d.png" % index_target), color)
+        if self.latent_dir is not None:
+            # objects are restricted to the clean index, so there is no
+            # fallback sample and read errors are raised
+            data.update(
+                self.load_latent_sample(
+                    self.paths[index], index_target, indices_cond, views
+                )
             )
-            cond_ims = torch.stack(
-                [
-                    self.process_im(
-                        self.load_im(
-                            os.path.join(filename, "%03d.png" % index_cond), color
-                        )
-                    )
-                    for index_cond in indices_cond
-                ]
-            )
-            target_RT = np.load(os.path.join(filename, "%03d.npy" % index_target))
-            cond_RT = np.load(os.path.join(filename, "%03d.npy" % indices_cond[0]))
+            data["cond_count"] = cond_count
+            if self.postprocess is not None:
+                data = self.postprocess(data)
+            return data
 
+        try:
+            target_im, cond_ims, d_T = self.load_sample(
+                self.paths[index], index_target, indices_cond, color, views
+            )
         except:
+            if self.clean_index is not None:
+                raise
             # very hacky solution, sorry about this
-            filename = os.path.join(
-                self.root_dir, "692db5f2d3a04bb286cb977a7dba903e"
-            )  # this one we know is valid
-            # target_im = torch.stack(
-            #     [
-            #         self.process_im(
-            #             self.load_im(
-            #                 os.path.join(filename, "%03d.png" % index_target), color
-            #             )
-            #         )
-            #     ]
-            #     * cond_count
-            # )
-            target_im = self.process_im(
-                self.load_im(os.path.join(filename, "%03d.png" % index_target), color)
-            )
-            cond_ims = torch.stack(
-                [
-                    self.process_im(
-                        self.load_im(
-                            os.path.join(filename, "%03d.png" % index_cond), color
-                        )
-                    )
-                    for index_cond in indices_cond
-                ]
+            # this one we know is valid
+            target_im, cond_ims, d_T = self.load_sample(
+                "692db5f2d3a04bb286cb977a7dba903e", index_target, indices_cond, color
             )
-            target_RT = np.load(os.path.join(filename, "%03d.npy" % index_target))
-            cond_RT = np.load(os.path.join(filename, "%03d.npy" % indices_cond[0]))
             target_im = torch.zeros_like(target_im)
             cond_ims = torch.zeros_like(cond_ims)
 
         data["image_target"] = target_im
         data["image_cond"] = cond_ims
         data["cond_count"] = cond_count
-        data["T"] = self.get_T(target_RT, cond_RT)
+        data["T"] = d_T
 
         if self.postprocess is not None:
             data = self.postprocess(data)
 
         return data
 
+    def object_views(self, uid):
+        """Return the per-worker LRU cache entry of `uid`, a dict of its
+        processed views and cached latents, or a new dict that is not cached
+        if object_cache_size is 0.
+        """
+        views = self.object_cache.pop(uid, {})
+        if self.object_cache_size > 0:
+            self.object_cache[uid] = views
+            if len(self.object_cache) > self.object_cache_size:
+                self.object_cache.popitem(last=False)
+        return views
+
+    def load_processed_view(self, uid, view, color, views):
+        if view not in views:
+            views[view] = self.process_im(self.load_view(uid, view, color))
+        return views[view]
+
+    def load_sample(self, uid, index_target, indices_cond, color, views=None):
+        if views is None:
+            views = self.object_views(uid)
+        target_im = self.load_processed_view(uid, index_target, color, views)
+        cond_ims = torch.stack(
+            [
+                self.load_processed_view(uid, index_cond, color, views)
+                for index_cond in indices_cond
+            ]
+        )
+        d_T = self.get_relative_pose(uid, index_target, indices_cond[0])
+        return target_im, cond_ims, d_T
+
+    def load_latents(self, uid):
+        latents = np.load(os.path.join(self.latent_dir, uid + ".npz"))
+        return latents["moments"], latents["clip"]
+
+    def load_latent_sample(self, uid, index_target, indices_cond, views=None):
+        if views is None:
+            views = self.object_views(uid)
+        if "latents" not in views:
+            views["latents"] = self.load_latents(uid)
+        moments, clip_emb = views["latents"]
+        return {
+            "latent_target": torch.from_numpy(moments[index_target]),
+            "latent_cond": torch.from_numpy(moments[indices_cond]),
+            "clip_cond": torch.from_numpy(clip_emb[indices_cond]),
+            "T": self.get_relative_pose(uid, index_target, indices_cond[0]),
+        }
+
     def process_im(self, im):
         im = im.convert("RGB")
+        if self.uint8:
+            return torch.from_numpy(np.array(self.tform(im))).permute(2, 0, 1)
         return self.tform(im)
 
 
@@ -0,0 +1,71 @@
+"""Long-lived inference engine for serving novel view requests.
+
+`InferenceEngine` holds the loaded model and a single `DDIMSampler` for all
+requests. The sampler caches the DDIM schedule of every step count it has
+seen, and each sampling run builds the classifier-free guidance conditioning
+once and reuses its UNet input buffers across steps (see
+`ldm.models.diffusion.ddim.StepInputs`). With `sampler="dpmpp_2m"` it samples
+with the multistep `DPMSolverSampler` instead.
+"""
+
+import torch
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.models.diffusion.dpm_solver import DPMSolverSampler
+from ldm.orbit import encode_input, sample_poses
+
+SAMPLERS = {"ddim": DDIMSampler, "dpmpp_2m": DPMSolverSampler}
+
+
+class InferenceEngine:
+    def __init__(self, model, precision="fp32", max_batch=16, sampler="ddim"):
+        self.model = model
+        self.sampler = SAMPLERS[sampler](model)
+        self.precision = precision
+        self.max_batch = max_batch
+
+    @classmethod
+    def from_config(cls, config, ckpt, device="cuda", **kwargs):
+        from ldm.checkpoint import load_model
+
+        return cls(load_model(config, ckpt, device), **kwargs)
+
+    def encode(self, input_im, precision=None):
+        return encode_input(self.model, input_im, precision or self.precision)
+
+    def sample(
+        self,
+        input_im,
+        poses,
+        n_samples=1,
+        ddim_steps=50,
+        scale=3.0,
+        ddim_eta=1.0,
+        precision=None,
+        encoded=None,
+    ):
+        """Yield `(pose_index, images)` for every pose, see `ldm.orbit.sample_poses`.
+
+        :param encoded: the output of `encode` for `input_im`, to skip encoding
+            an input again that was already encoded for an earlier request.
+        """
+        precision = precision or self.precision
+        if encoded is None:
+            encoded = self.encode(input_im, precision)
+        return sample_poses(
+            self.model,
+            encoded,
+            poses,
+            sampler=self.sampler,
+            n_samples=n_samples,
+            ddim_steps=ddim_steps,
+            scale=scale,
+            ddim_eta=ddim_eta,
+            precision=precision,
+            max_batch=self.max_batch,
+        )
+
+    @torch.no_grad()
+    def sample_pose(self, input_im, pose, n_samples=4, **kwargs):
+        """The `[n_samples, 3, H, W]` samples in [0, 1] of a single pose."""
+        _, images = next(self.sample(input_im, [pose], n_samples=n_samples, **kwargs))
+        return images
@@ -1,7 +1,7 @@
 from pathlib import Path
 from omegaconf import OmegaConf
 import torch
-from ldm.util import instantiate_from_config
+from ldm.checkpoint import load_model
 import logging
 from contextlib import contextmanager
 
@@ -60,18 +60,6 @@ def load_model_from_config(config, ckpt, device="cpu", verbose=False):
         config = OmegaConf.load(config)
 
     with all_logging_disabled():
-        print(f"Loading model from {ckpt}")
-        pl_sd = torch.load(ckpt, map_location="cpu")
-        global_step = pl_sd["global_step"]
-        sd = pl_sd["state_dict"]
-        model = instantiate_from_config(config.model)
-        m, u = model.load_state_dict(sd, strict=False)
-        if len(m) > 0 and verbose:
-            print("missing keys:")
-            print(m)
-        if len(u) > 0 and verbose:
-            print("unexpected keys:")
-        model.to(device)
-        model.eval()
+        model = load_model(config, ckpt, device, verbose=verbose)
         model.cond_stage_model.device = device
         return model
\ No newline at end of file
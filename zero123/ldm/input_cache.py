@@ -0,0 +1,81 @@
+"""Content-addressed cache of the per-image work of the demo entry points.
+
+Requests that resubmit the same image with different camera settings can skip
+the safety checker, the background removal and the CLIP / VAE encoders. An
+entry is a dict filled in by the caller and added with `save` once complete,
+usually with
+
+    "nsfw":    the safety checker verdict
+    "image":   the preprocessed (H, W, 3) input in [0, 1]
+    "encoded": the CLIP embedding and VAE latent of `ldm.orbit.encode_input`
+
+Entries are keyed by a hash of the image content and the given parameters
+(preprocess flag, resolution, ...). They live in an in-memory LRU and, with
+`cache_dir`, in a disk tier that survives restarts and is shared between
+processes.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+
+class InputCache:
+    def __init__(self, max_entries=64, cache_dir=None, device="cpu"):
+        """
+        :param max_entries: entries kept in memory, least recently used first
+            out.
+        :param cache_dir: optional directory of the disk tier.
+        :param device: device the tensors of disk entries are loaded to.
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.device = device
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(image, **params):
+        """Hash of a PIL image's pixels and `params`."""
+        h = hashlib.sha256()
+        h.update(f"{image.mode}{image.size}".encode())
+        h.update(image.tobytes())
+        h.update(repr(sorted(params.items())).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def get(self, key):
+        """The entry of `key`, a new empty one if missing that only `save` adds."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if self.cache_dir is None or not os.path.exists(self.path(key)):
+            return {}
+        entry = torch.load(self.path(key), map_location=self.device)
+        self.insert(key, entry)
+        return entry
+
+    def insert(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def save(self, key, entry):
+        """Cache `entry` as the entry of `key`, also on disk if there is a disk tier."""
+        self.insert(key, entry)
+        if self.cache_dir is None:
+            return
+        tmp = f"{self.path(key)}.{os.getpid()}.tmp"
+        torch.save(entry, tmp)
+        os.replace(tmp, self.path(key))
@@ -11,6 +11,7 @@ from ldm.models.diffusion.sampling_util import (
     spatial_norm_thresholding,
 )
 from ldm.modules.diffusionmodules.util import (
+    aggregate_views,
     extract_into_tensor,
     make_ddim_sampling_parameters,
     make_ddim_timesteps,
@@ -19,12 +20,127 @@ from ldm.modules.diffusionmodules.util import (
 from tqdm import tqdm
 
 
+def select_target_rows(c, cond_counts):
+    """Keep the row of the first view of every target in a conditioning
+    given per view. Conditionings that are already given per target are
+    returned unchanged.
+    """
+    if isinstance(c, dict):
+        return {k: select_target_rows(v, cond_counts) for k, v in c.items()}
+    if isinstance(c, list):
+        return [select_target_rows(v, cond_counts) for v in c]
+    if c.shape[0] == cond_counts.shape[0]:
+        return c
+    first_views = torch.cumsum(cond_counts, 0) - cond_counts
+    return c[first_views.to(c.device)]
+
+
+def concat_conditioning(uc, c):
+    if isinstance(c, dict):
+        assert isinstance(uc, dict)
+        c_in = dict()
+        for k in c:
+            if isinstance(c[k], list):
+                c_in[k] = [torch.cat([uc[k][i], c[k][i]]) for i in range(len(c[k]))]
+            else:
+                c_in[k] = torch.cat([uc[k], c[k]])
+        return c_in
+    return torch.cat([uc, c])
+
+
+class StepInputs:
+    """UNet inputs of the DDIM steps of one request.
+
+    The conditioning, concatenated with the unconditional one for classifier-
+    free guidance, is built once. Every step only gathers x and t into the
+    rows of the UNet batch, reusing the same buffers.
+    """
+
+    def __init__(
+        self, c, cond_counts, unconditional_conditioning=None, uncond_per_target=False
+    ):
+        b = cond_counts.shape[0]
+        targets = torch.arange(b, device=cond_counts.device)
+        view_rows = torch.repeat_interleave(targets, cond_counts)
+        self.guided = unconditional_conditioning is not None
+        self.uncond_per_target = self.guided and uncond_per_target
+        if not self.guided:
+            rows = view_rows
+            self.c_in = c
+        elif self.uncond_per_target:
+            # the unconditional rows of a target are identical for all of
+            # its views, so they only have to go through the UNet once
+            rows = torch.cat([targets, view_rows])
+            uc = select_target_rows(unconditional_conditioning, cond_counts)
+            self.c_in = concat_conditioning(uc, c)
+        else:
+            rows = torch.cat([view_rows, view_rows])
+            self.c_in = concat_conditioning(unconditional_conditioning, c)
+        self.rows = rows
+        self.num_views = view_rows.shape[0]
+        self.x_in = None
+        self.t_in = None
+
+    def __call__(self, x, t):
+        if self.x_in is None or self.x_in.device != x.device:
+            self.rows = self.rows.to(x.device)
+            self.x_in = x.new_empty((self.rows.shape[0], *x.shape[1:]))
+            self.t_in = t.new_empty((self.rows.shape[0],))
+        torch.index_select(x, 0, self.rows, out=self.x_in)
+        torch.index_select(t, 0, self.rows, out=self.t_in)
+        return self.x_in, self.t_in
+
+
+def guided_eps(model, x, t, cond_counts, inputs, unconditional_guidance_scale=1.0):
+    """Noise prediction of every target of `x` at `t`.
+
+    Runs the UNet on the rows built by `inputs` (a `StepInputs`), combines the
+    views of every target with `aggregate_views` and applies classifier-free
+    guidance. Shared by all samplers of the multi-view model.
+    """
+    b = cond_counts.shape[0]
+    x_in, t_in = inputs(x, t)
+    model_output = model.apply_model(x_in, t_in, inputs.c_in, cond_counts)
+    if not inputs.guided:
+        return aggregate_views(model_output, cond_counts)
+    if inputs.uncond_per_target:
+        model_output_uncond, model_output = model_output[:b], model_output[b:]
+        # equal logits over identical views reduce to plain averaging
+        e_t_uncond = model_output_uncond.chunk(2, dim=1)[0]
+    else:
+        model_output_uncond, model_output = model_output.chunk(2)
+        e_t_uncond = aggregate_views(model_output_uncond, cond_counts)
+    e_t = aggregate_views(model_output, cond_counts)
+    return e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+
+
+# attributes set by DDIMSampler.make_schedule, cached per schedule
+SCHEDULE_ATTRS = (
+    "ddim_timesteps",
+    "betas",
+    "alphas_cumprod",
+    "alphas_cumprod_prev",
+    "sqrt_alphas_cumprod",
+    "sqrt_one_minus_alphas_cumprod",
+    "log_one_minus_alphas_cumprod",
+    "sqrt_recip_alphas_cumprod",
+    "sqrt_recipm1_alphas_cumprod",
+    "ddim_sigmas",
+    "ddim_alphas",
+    "ddim_alphas_prev",
+    "ddim_sqrt_one_minus_alphas",
+    "ddim_sigmas_for_original_num_steps",
+    "ddim_step_coefficients",
+)
+
+
 class DDIMSampler(object):
     def __init__(self, model, schedule="linear", **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.schedules = {}
 
     def to(self, device):
         """Same as to in torch module
@@ -43,6 +159,10 @@ class DDIMSampler(object):
     def make_schedule(
         self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0.0, verbose=True
     ):
+        key = (ddim_num_steps, ddim_discretize, float(ddim_eta), self.model.device)
+        if key in self.schedules:
+            self.__dict__.update(self.schedules[key])
+            return
         self.ddim_timesteps = make_ddim_timesteps(
             ddim_discr_method=ddim_discretize,
             num_ddim_timesteps=ddim_num_steps,
@@ -99,6 +219,21 @@ class DDIMSampler(object):
         self.register_buffer(
             "ddim_sigmas_for_original_num_steps", sigmas_for_original_sampling_steps
         )
+        # [4, S] per-step coefficients, indexed in p_sample_ddim instead of
+        # filling new tensors at every step
+        self.ddim_step_coefficients = torch.tensor(
+            np.stack(
+                [
+                    np.asarray(ddim_alphas, dtype=np.float64),
+                    np.asarray(ddim_alphas_prev, dtype=np.float64),
+                    np.asarray(ddim_sigmas, dtype=np.float64),
+                    np.sqrt(1.0 - np.asarray(ddim_alphas, dtype=np.float64)),
+                ]
+            ),
+            dtype=torch.float32,
+            device=self.model.device,
+        )
+        self.schedules[key] = {name: getattr(self, name) for name in SCHEDULE_ATTRS}
 
     @torch.no_grad()
     def sample(
@@ -125,6 +260,7 @@ class DDIMSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,  # this has to come in the same format as the conditioning, # e.g. as encoded tokens, ...
         dynamic_threshold=None,
+        uncond_per_target=False,
         **kwargs,
     ):
         if conditioning is not None:
@@ -169,6 +305,7 @@ class DDIMSampler(object):
             unconditional_guidance_scale=unconditional_guidance_scale,
             unconditional_conditioning=unconditional_conditioning,
             dynamic_threshold=dynamic_threshold,
+            uncond_per_target=uncond_per_target,
         )
         return samples, intermediates
 
@@ -195,6 +332,7 @@ class DDIMSampler(object):
         unconditional_conditioning=None,
         dynamic_threshold=None,
         t_start=-1,
+        uncond_per_target=False,
     ):
         device = self.model.betas.device
         b = shape[0]
@@ -233,6 +371,17 @@ class DDIMSampler(object):
 
         iterator = tqdm(time_range, desc="DDIM Sampler", total=total_steps)
 
+        guided = (
+            unconditional_conditioning is not None
+            and unconditional_guidance_scale != 1.0
+        )
+        inputs = StepInputs(
+            cond,
+            cond_counts,
+            unconditional_conditioning if guided else None,
+            uncond_per_target,
+        )
+
         for i, step in enumerate(iterator):
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
@@ -259,6 +408,8 @@ class DDIMSampler(object):
                 unconditional_guidance_scale=unconditional_guidance_scale,
                 unconditional_conditioning=unconditional_conditioning,
                 dynamic_threshold=dynamic_threshold,
+                uncond_per_target=uncond_per_target,
+                inputs=inputs,
             )
             img, pred_x0 = outs
             if callback:
@@ -290,150 +441,54 @@ class DDIMSampler(object):
         unconditional_guidance_scale=1.0,
         unconditional_conditioning=None,
         dynamic_threshold=None,
+        uncond_per_target=False,
+        inputs=None,
     ):
+        """
+        :param inputs: the `StepInputs` of the request, shared by all of its
+            steps. Built from the conditioning for this step if not given.
+        """
         b, *_, device = *cond_counts.shape, x.device
 
-        t_model = torch.repeat_interleave(t, cond_counts, dim=0)
-        x_model = torch.repeat_interleave(x, cond_counts, dim=0)
-        if unconditional_conditioning is None or unconditional_guidance_scale == 1.0:
-            model_output = self.model.apply_model(x_model, t_model, c, cond_counts)
-
-            view_delimiters = torch.cumsum(cond_counts, 0).tolist()
-            view_delimiters.insert(0, 0)
-            noise_weight_delim = model_output.shape[1] // 2
-            noise_all, logits = (
-                model_output[:, :noise_weight_delim, ...],
-                model_output[:, noise_weight_delim:, ...],
-            )
-            logits_padded = torch.nn.utils.rnn.pad_sequence(
-                [
-                    logits[idx1:idx2]
-                    for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-                ],
-                batch_first=True,
-                padding_value=float("-inf"),
-            )
-            weights_softmax = torch.nn.functional.softmax(logits_padded, dim=1)
-            noise_padded = torch.nn.utils.rnn.pad_sequence(
-                [
-                    noise_all[idx1:idx2]
-                    for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-                ],
-                batch_first=True,
-            )
-            noise_weighted = noise_padded * weights_softmax
-
-            e_t = noise_weighted.sum(dim=1)
-        else:
-            x_in = torch.cat([x_model] * 2)
-            t_in = torch.cat([t_model] * 2)
-            # t_in = t_model
-            if isinstance(c, dict):
-                assert isinstance(unconditional_conditioning, dict)
-                c_in = dict()
-                for k in c:
-                    if isinstance(c[k], list):
-                        c_in[k] = [
-                            torch.cat([unconditional_conditioning[k][i], c[k][i]])
-                            for i in range(len(c[k]))
-                        ]
-                    else:
-                        c_in[k] = torch.cat([unconditional_conditioning[k], c[k]])
-            else:
-                c_in = torch.cat([unconditional_conditioning, c])
-            # print(c_in.shape)
-            # print(type(self.model))
-            model_output_uncond, model_output = self.model.apply_model(
-                x_in, t_in, c_in, cond_counts
-            ).chunk(2)
-
-            # COND WEIGHTING
-            view_delimiters = torch.cumsum(cond_counts, 0).tolist()
-            view_delimiters.insert(0, 0)
-            noise_weight_delim = model_output.shape[1] // 2
-            noise_all, logits = (
-                model_output[:, :noise_weight_delim, ...],
-                model_output[:, noise_weight_delim:, ...],
-            )
-            logits_padded = torch.nn.utils.rnn.pad_sequence(
-                [
-                    logits[idx1:idx2]
-                    for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-                ],
-                batch_first=True,
-                padding_value=float("-inf"),
-            )
-            weights_softmax = torch.nn.functional.softmax(logits_padded, dim=1)
-            noise_padded = torch.nn.utils.rnn.pad_sequence(
-                [
-                    noise_all[idx1:idx2]
-                    for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-                ],
-                batch_first=True,
-            )
-            noise_weighted = noise_padded * weights_softmax
-
-            e_t = noise_weighted.sum(dim=1)
-
-            # UNCOND WEIGHTING
-            view_delimiters = torch.cumsum(cond_counts, 0).tolist()
-            view_delimiters.insert(0, 0)
-            noise_weight_delim = model_output_uncond.shape[1] // 2
-            noise_all, logits = (
-                model_output_uncond[:, :noise_weight_delim, ...],
-                model_output_uncond[:, noise_weight_delim:, ...],
-            )
-            logits_padded = torch.nn.utils.rnn.pad_sequence(
-                [
-                    logits[idx1:idx2]
-                    for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-                ],
-                batch_first=True,
-                padding_value=float("-inf"),
+        if inputs is None:
+            guided = (
+                unconditional_conditioning is not None
+                and unconditional_guidance_scale != 1.0
             )
-            weights_softmax = torch.nn.functional.softmax(logits_padded, dim=1)
-            noise_padded = torch.nn.utils.rnn.pad_sequence(
-                [
-                    noise_all[idx1:idx2]
-                    for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-                ],
-                batch_first=True,
+            inputs = StepInputs(
+                c,
+                cond_counts,
+                unconditional_conditioning if guided else None,
+                uncond_per_target,
             )
-            noise_weighted = noise_padded * weights_softmax
-
-            e_t_uncond = noise_weighted.sum(dim=1)
-
-            e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
+        e_t = guided_eps(
+            self.model, x, t, cond_counts, inputs, unconditional_guidance_scale
+        )
 
         if score_corrector is not None:
             assert self.model.parameterization == "eps"
+            # the conditional rows of every view come last
+            x_model = inputs.x_in[inputs.x_in.shape[0] - inputs.num_views :]
             e_t = score_corrector.modify_score(
                 self.model, e_t, x_model, t, c, **corrector_kwargs
             )
 
-        alphas = self.model.alphas_cumprod if use_original_steps else self.ddim_alphas
-        alphas_prev = (
-            self.model.alphas_cumprod_prev
-            if use_original_steps
-            else self.ddim_alphas_prev
-        )
-        sqrt_one_minus_alphas = (
-            self.model.sqrt_one_minus_alphas_cumprod
-            if use_original_steps
-            else self.ddim_sqrt_one_minus_alphas
-        )
-        sigmas = (
-            self.model.ddim_sigmas_for_original_num_steps
-            if use_original_steps
-            else self.ddim_sigmas
-        )
         # select parameters corresponding to the currently considered timestep
-        a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
-        a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
-        sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
-        sqrt_one_minus_at = torch.full(
-            (b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device
-        )
+        if use_original_steps:
+            alphas = self.model.alphas_cumprod
+            alphas_prev = self.model.alphas_cumprod_prev
+            sqrt_one_minus_alphas = self.model.sqrt_one_minus_alphas_cumprod
+            sigmas = self.model.ddim_sigmas_for_original_num_steps
+            a_t = torch.full((b, 1, 1, 1), alphas[index], device=device)
+            a_prev = torch.full((b, 1, 1, 1), alphas_prev[index], device=device)
+            sigma_t = torch.full((b, 1, 1, 1), sigmas[index], device=device)
+            sqrt_one_minus_at = torch.full(
+                (b, 1, 1, 1), sqrt_one_minus_alphas[index], device=device
+            )
+        else:
+            # 0-dim views that broadcast against x
+            coefficients = self.ddim_step_coefficients.to(device)[:, index]
+            a_t, a_prev, sigma_t, sqrt_one_minus_at = coefficients.unbind()
 
         # current prediction for x_0
         # print("e_t shape", e_t.shape)
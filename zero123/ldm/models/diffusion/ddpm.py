@@ -19,6 +19,7 @@ from ldm.models.autoencoder import AutoencoderKL, IdentityFirstStage, VQModelInt
 from ldm.models.diffusion.ddim import DDIMSampler
 from ldm.modules.attention import CrossAttention
 from ldm.modules.diffusionmodules.util import (
+    aggregate_views,
     extract_into_tensor,
     make_beta_schedule,
     noise_like,
@@ -27,7 +28,8 @@ from ldm.modules.distributions.distributions import (
     DiagonalGaussianDistribution,
     normal_kl,
 )
-from ldm.modules.ema import LitEma
+from ldm.modules.ema import FlatEma, LitEma
+from ldm.profiler import profiler
 from ldm.util import (
     count_params,
     default,
@@ -90,6 +92,7 @@ class DDPM(pl.LightningModule):
         logvar_init=0.0,
         make_it_fit=False,
         ucg_training=None,
+        ema_config=None,
     ):
         super().__init__()
         assert parameterization in [
@@ -111,8 +114,13 @@ class DDPM(pl.LightningModule):
         count_params(self.model, verbose=True)
         self.use_ema = use_ema
         if self.use_ema:
-            self.model_ema = LitEma(self.model)
-            print(f"Keeping EMAs of {len(list(self.model_ema.buffers()))}.")
+            if ema_config is not None:
+                # e.g. {update_every: 4, device: cpu, pin_memory: true}
+                self.model_ema = FlatEma(self.model, **ema_config)
+                print(f"Keeping flat EMAs of {len(self.model_ema.shadow_params)}.")
+            else:
+                self.model_ema = LitEma(self.model)
+                print(f"Keeping EMAs of {len(list(self.model_ema.buffers()))}.")
 
         self.use_scheduler = scheduler_config is not None
         if self.use_scheduler:
@@ -481,6 +489,11 @@ class DDPM(pl.LightningModule):
 
     def get_input(self, batch, k):
         x = batch[k]
+        if x.dtype == torch.uint8:
+            # channel-first uint8 images from ObjaverseData(uint8=True) are
+            # normalized on the model device
+            x = x.to(self.device, non_blocking=True).float() / 127.5 - 1.0
+            return x.to(memory_format=torch.contiguous_format)
         if len(x.shape) == 3:
             x = x[..., None]
 
@@ -542,9 +555,14 @@ class DDPM(pl.LightningModule):
             loss_dict_ema, prog_bar=False, logger=True, on_step=False, on_epoch=True
         )
 
+    def backward(self, loss, optimizer, optimizer_idx, *args, **kwargs):
+        with profiler.stage("unet_backward"):
+            super().backward(loss, optimizer, optimizer_idx, *args, **kwargs)
+
     def on_train_batch_end(self, *args, **kwargs):
         if self.use_ema:
-            self.model_ema(self.model)
+            with profiler.stage("ema"):
+                self.model_ema(self.model)
 
     def _get_rows_from_list(self, samples):
         n_imgs_per_row = len(samples)
@@ -618,6 +636,7 @@ class LatentDiffusion(DDPM):
         scale_factor=1.0,
         scale_by_std=False,
         unet_trainable=True,
+        frozen_stage_dtype=None,
         *args,
         **kwargs,
     ):
@@ -647,6 +666,12 @@ class LatentDiffusion(DDPM):
         self.instantiate_first_stage(first_stage_config)
         self.instantiate_cond_stage(cond_stage_config)
         self.cond_stage_forward = cond_stage_forward
+        # frozen encoders run without autograd, optionally under autocast
+        self.frozen_stage_dtype = (
+            getattr(torch, frozen_stage_dtype) if frozen_stage_dtype else None
+        )
+        # cached output of get_learned_conditioning([""]), see get_null_prompt
+        self.register_buffer("null_prompt", None, persistent=False)
 
         # construct linear projection layer for concatenating image CLIP embedding and RT
         self.cc_projection = nn.Linear(772, 768)
@@ -717,6 +742,25 @@ class LatentDiffusion(DDPM):
         if self.shorten_cond_schedule:
             self.make_cond_schedule()
 
+    @contextmanager
+    def frozen_stage_scope(self):
+        """Run frozen encoders without recording activations for backward, in
+        frozen_stage_dtype if set."""
+        with torch.no_grad(), torch.autocast(
+            self.device.type,
+            dtype=self.frozen_stage_dtype,
+            enabled=self.frozen_stage_dtype is not None,
+        ):
+            yield
+
+    def get_null_prompt(self):
+        if self.cond_stage_trainable:
+            return self.get_learned_conditioning([""])
+        if self.null_prompt is None:
+            with torch.no_grad():
+                self.null_prompt = self.get_learned_conditioning([""]).float()
+        return self.null_prompt
+
     def instantiate_first_stage(self, config):
         model = instantiate_from_config(config)
         self.first_stage_model = model.eval()
@@ -928,7 +972,13 @@ class LatentDiffusion(DDPM):
         bs=None,
         uncond=0.05,
     ):
-        x = super().get_input(batch, k)
+        # batches from ObjaverseData(latent_dir=...) carry the cached encoder
+        # outputs instead of the images, see ldm.data.objaverse_latents
+        use_cached_latents = "latent_target" in batch
+        if use_cached_latents:
+            x = batch["latent_target"].float()
+        else:
+            x = super().get_input(batch, k)
         T = batch["T"].to(memory_format=torch.contiguous_format).float()
         cond_counts = batch["cond_count"]
         # print(cond_counts)
@@ -943,30 +993,48 @@ class LatentDiffusion(DDPM):
         T = torch.repeat_interleave(T, cond_counts, dim=0)
 
         x = x.to(self.device)
-        encoder_posterior = self.encode_first_stage(x)
-        z = self.get_first_stage_encoding(encoder_posterior).detach()
+        if use_cached_latents:
+            encoder_posterior = DiagonalGaussianDistribution(x)
+            x = None
+        else:
+            with profiler.stage("vae_encode"), self.frozen_stage_scope():
+                encoder_posterior = self.encode_first_stage(x)
+        z = self.get_first_stage_encoding(encoder_posterior).detach().float()
         cond_key = cond_key or self.cond_stage_key
-        xc = super().get_input(batch, cond_key).to(self.device)
-        # print("x xc", x.shape, xc.shape, sep=" ")
-        if bs is not None:
-            xc = xc[: sum(cond_counts)]
+        if use_cached_latents:
+            xc = None
+            cached_moments = batch["latent_cond"].to(self.device).float()
+            cached_clip_emb = batch["clip_cond"].to(self.device).float()
+            if bs is not None:
+                cached_moments = cached_moments[: sum(cond_counts)]
+                cached_clip_emb = cached_clip_emb[: sum(cond_counts)]
+        else:
+            xc = super().get_input(batch, cond_key).to(self.device)
+            # print("x xc", x.shape, xc.shape, sep=" ")
+            if bs is not None:
+                xc = xc[: sum(cond_counts)]
         cond = {}
 
         # To support classifier-free guidance, randomly drop out only text conditioning 5%, only image conditioning 5%, and both 5%.
-        random = torch.rand(sum(cond_counts), device=x.device)
+        random = torch.rand(sum(cond_counts), device=self.device)
         prompt_mask = rearrange(random < 2 * uncond, "n -> n 1 1")
         input_mask = 1 - rearrange(
             (random >= uncond).float() * (random < 3 * uncond).float(), "n -> n 1 1 1"
         )
-        null_prompt = self.get_learned_conditioning([""])
+        # [1, 1, 768], broadcast by torch.where below
+        null_prompt = self.get_null_prompt()
 
         # z.shape: [8, 4, 64, 64]; c.shape: [8, 1, 768]
         # print('=========== xc shape ===========', xc.shape)
         with torch.enable_grad():
-            clip_emb = self.get_learned_conditioning(xc).detach()
-            null_prompt = torch.cat(
-                [self.get_learned_conditioning([""]).detach()] * sum(cond_counts)
-            )
+            if use_cached_latents:
+                clip_emb = cached_clip_emb
+            elif self.cond_stage_trainable:
+                with profiler.stage("clip_encode"):
+                    clip_emb = self.get_learned_conditioning(xc).detach()
+            else:
+                with profiler.stage("clip_encode"), self.frozen_stage_scope():
+                    clip_emb = self.get_learned_conditioning(xc).float()
             # print(xc.shape)
             # print(null_prompt.shape, clip_emb.shape)
             # print(prompt_mask.shape)
@@ -983,10 +1051,15 @@ class LatentDiffusion(DDPM):
                 )
             ]
         # print(cond["c_crossattn"][0].shape)
-        view_delimiters = (torch.cumsum(cond_counts, 0) - cond_counts[0]).tolist()
-        first_stage_encoded = (
-            self.encode_first_stage((xc.to(self.device))).mode().detach()
-        )
+        # first view of every target, the segment starts of aggregate_views
+        view_delimiters = (torch.cumsum(cond_counts, 0) - cond_counts).long()
+        if use_cached_latents:
+            first_stage_encoded = DiagonalGaussianDistribution(cached_moments).mode()
+        else:
+            with profiler.stage("vae_encode"), self.frozen_stage_scope():
+                first_stage_encoded = (
+                    self.encode_first_stage(xc.to(self.device)).mode().float()
+                )
         relative_views = first_stage_encoded[view_delimiters]
         relative_views_stacked = torch.repeat_interleave(
             relative_views, cond_counts, dim=0
@@ -1000,8 +1073,12 @@ class LatentDiffusion(DDPM):
         out = [z, cond, cond_counts]
         if return_first_stage_outputs:
             xrec = self.decode_first_stage(z)
+            if x is None:
+                x = xrec
             out.extend([x, xrec])
         if return_original_cond:
+            if xc is None:
+                xc = self.decode_first_stage(self.scale_factor * first_stage_encoded)
             out.append(xc)
         return out
 
@@ -1320,46 +1397,20 @@ class LatentDiffusion(DDPM):
 
         x_noisy = self.q_sample(x_start=x_start, t=t, noise=noise)
         x_noisy = torch.repeat_interleave(x_noisy, cond_counts, dim=0)
-        noise = torch.repeat_interleave(noise, cond_counts, dim=0)
         t_model = torch.repeat_interleave(t, cond_counts, dim=0)
 
-        model_output = self.apply_model(x_noisy, t_model, cond, cond_counts)
-
-        view_delimiters = torch.cumsum(cond_counts, 0).tolist()
-        view_delimiters.insert(0, 0)
-        noise_weight_delim = model_output.shape[1] // 2
-        noise_all, logits = (
-            model_output[:, :noise_weight_delim, ...],
-            model_output[:, noise_weight_delim:, ...],
-        )
-        logits_padded = torch.nn.utils.rnn.pad_sequence(
-            [
-                logits[idx1:idx2]
-                for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-            ],
-            batch_first=True,
-            padding_value=float("-inf"),
-        )
-        weights_softmax = torch.nn.functional.softmax(logits_padded, dim=1)
-        noise_padded = torch.nn.utils.rnn.pad_sequence(
-            [
-                noise_all[idx1:idx2]
-                for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-            ],
-            batch_first=True,
-        )
-        noise_weighted = noise_padded * weights_softmax
-
-        model_output_aggregated = noise_weighted.sum(dim=1)
+        with profiler.stage("unet_forward"):
+            model_output = self.apply_model(x_noisy, t_model, cond, cond_counts)
+            model_output_aggregated = aggregate_views(model_output, cond_counts)
         # print("MODEL OUT AGG", model_output_aggregated.shape)
 
         loss_dict = {}
         prefix = "train" if self.training else "val"
 
         if self.parameterization == "x0":
-            target = x_start[view_delimiters[:-1]]
+            target = x_start
         elif self.parameterization == "eps":
-            target = noise[view_delimiters[:-1]]
+            target = noise
         else:
             raise NotImplementedError()
 
@@ -1409,33 +1460,7 @@ class LatentDiffusion(DDPM):
             model_out = score_corrector.modify_score(
                 self, model_out, x, t, c, **corrector_kwargs
             )
-        view_delimiters = torch.cumsum(cond_counts, 0).tolist()
-        view_delimiters.insert(0, 0)
-
-        noise_weight_delim = model_out.shape[1] // 2
-        noise_all, logits = (
-            model_out[:, :noise_weight_delim, ...],
-            model_out[:, noise_weight_delim:, ...],
-        )
-        logits_padded = torch.nn.utils.rnn.pad_sequence(
-            [
-                logits[idx1:idx2]
-                for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-            ],
-            batch_first=True,
-            padding_value=float("-inf"),
-        )
-        weights_softmax = torch.nn.functional.softmax(logits_padded, dim=1)
-        noise_padded = torch.nn.utils.rnn.pad_sequence(
-            [
-                noise_all[idx1:idx2]
-                for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
-            ],
-            batch_first=True,
-        )
-        noise_weighted = noise_padded * weights_softmax
-
-        model_out_aggregated = noise_weighted.sum(dim=1)
+        model_out_aggregated = aggregate_views(model_out, cond_counts)
 
         # not in use
         if return_codebook_ids:
@@ -1910,6 +1935,7 @@ class LatentDiffusion(DDPM):
                     eta=ddim_eta,
                     unconditional_guidance_scale=unconditional_guidance_scale,
                     unconditional_conditioning=uc,
+                    uncond_per_target=True,
                 )
                 x_samples_cfg = self.decode_first_stage(samples_cfg)
                 log[f"samples_cfg_scale_{unconditional_guidance_scale:.2f}"] = (
@@ -0,0 +1,163 @@
+"""SAMPLING ONLY.
+
+Multistep second order DPM-Solver++ (DPM-Solver++ 2M, Lu et al. 2022) for the
+multi-view model. It uses the same UNet inputs, view aggregation and
+classifier-free guidance as `DDIMSampler` (see `ldm.models.diffusion.ddim.
+guided_eps`), and accepts the same `sample()` arguments. Compare its quality
+against DDIM at a given number of steps with scripts/bench_samplers.py.
+"""
+
+import numpy as np
+import torch
+from ldm.models.diffusion.ddim import StepInputs, guided_eps
+from ldm.models.diffusion.sampling_util import norm_thresholding
+from tqdm import tqdm
+
+
+class DPMSolverSampler(object):
+    def __init__(self, model, lower_order_final=True, **kwargs):
+        """
+        The first step always uses the first order update, since there is no
+        previous prediction yet.
+
+        :param lower_order_final: also take the last step with the first order
+            update when sampling with fewer than 15 steps, which is more stable
+            for guided sampling with very few steps.
+        """
+        super().__init__()
+        self.model = model
+        self.ddpm_num_timesteps = model.num_timesteps
+        self.lower_order_final = lower_order_final
+        self.schedules = {}
+
+    def make_schedule(self, num_steps, verbose=True):
+        """Time-uniform timesteps from T - 1 down to 0 and, per step, the
+        coefficients of the update as a [6, num_steps] table:
+
+            pred_x0 = x / alpha_s - sigma_s / alpha_s * e_t
+            d = w_cur * pred_x0 + w_prev * pred_x0_prev
+            x_t = sigma_t / sigma_s * x - alpha_t * (exp(-h) - 1) * d
+
+        with h = lambda_t - lambda_s and lambda = log(alpha / sigma). The first
+        order steps have w_cur = 1 and w_prev = 0.
+        """
+        key = (num_steps, self.model.device)
+        if key in self.schedules:
+            self.timesteps, self.step_coefficients = self.schedules[key]
+            return
+        assert 0 < num_steps < self.ddpm_num_timesteps
+        timesteps = np.linspace(self.ddpm_num_timesteps - 1, 0, num_steps + 1)
+        timesteps = timesteps.round().astype(np.int64)
+        alphas_cumprod = self.model.alphas_cumprod.cpu().double().numpy()[timesteps]
+        alphas = np.sqrt(alphas_cumprod)
+        sigmas = np.sqrt(1.0 - alphas_cumprod)
+        lambdas = np.log(alphas) - np.log(sigmas)
+        h = lambdas[1:] - lambdas[:-1]
+
+        w_cur = np.ones(num_steps)
+        w_prev = np.zeros(num_steps)
+        r = h[:-1] / h[1:]
+        w_cur[1:] = 1.0 + 0.5 / r
+        w_prev[1:] = -0.5 / r
+        if self.lower_order_final and num_steps < 15:
+            w_cur[-1], w_prev[-1] = 1.0, 0.0
+
+        self.timesteps = timesteps[:-1]
+        self.step_coefficients = torch.tensor(
+            np.stack(
+                [
+                    1.0 / alphas[:-1],
+                    sigmas[:-1] / alphas[:-1],
+                    sigmas[1:] / sigmas[:-1],
+                    -alphas[1:] * np.expm1(-h),
+                    w_cur,
+                    w_prev,
+                ]
+            ),
+            dtype=torch.float32,
+            device=self.model.device,
+        )
+        if verbose:
+            print(f"Selected timesteps for DPM-Solver++ sampler: {timesteps}")
+        self.schedules[key] = (self.timesteps, self.step_coefficients)
+
+    @torch.no_grad()
+    def sample(
+        self,
+        S,
+        batch_size,
+        shape,
+        conditioning=None,
+        cond_counts=None,
+        callback=None,
+        img_callback=None,
+        mask=None,
+        x0=None,
+        verbose=True,
+        x_T=None,
+        log_every_t=100,
+        unconditional_guidance_scale=1.0,
+        unconditional_conditioning=None,
+        dynamic_threshold=None,
+        uncond_per_target=False,
+        **kwargs,
+    ):
+        """Same arguments as `DDIMSampler.sample`. The solver is deterministic,
+        so the arguments of the stochastic DDIM steps (eta, temperature,
+        noise_dropout) are ignored.
+        """
+        assert self.model.parameterization == "eps"
+        self.make_schedule(S, verbose=verbose)
+        C, H, W = shape
+        size = (batch_size, C, H, W)
+        print(f"Data shape for DPM-Solver++ sampling is {size}")
+
+        device = self.model.betas.device
+        img = torch.randn(size, device=device) if x_T is None else x_T
+        guided = (
+            unconditional_conditioning is not None
+            and unconditional_guidance_scale != 1.0
+        )
+        inputs = StepInputs(
+            conditioning,
+            cond_counts,
+            unconditional_conditioning if guided else None,
+            uncond_per_target,
+        )
+        coefficients = self.step_coefficients.to(device)
+
+        intermediates = {"x_inter": [img], "pred_x0": [img]}
+        pred_x0_prev = None
+        iterator = tqdm(self.timesteps, desc="DPM-Solver++ Sampler", total=S)
+        for i, step in enumerate(iterator):
+            ts = torch.full((batch_size,), step, device=device, dtype=torch.long)
+            if mask is not None:
+                assert x0 is not None
+                img = self.model.q_sample(x0, ts) * mask + (1.0 - mask) * img
+
+            e_t = guided_eps(
+                self.model, img, ts, cond_counts, inputs, unconditional_guidance_scale
+            )
+            # 0-dim views that broadcast against x
+            step_coefficients = coefficients[:, i].unbind()
+            recip_alpha, sigma_over_alpha, ratio, phi, w_cur, w_prev = step_coefficients
+            pred_x0 = recip_alpha * img - sigma_over_alpha * e_t
+            if dynamic_threshold is not None:
+                pred_x0 = norm_thresholding(pred_x0, dynamic_threshold)
+            if pred_x0_prev is None:
+                d = pred_x0
+            else:
+                d = w_cur * pred_x0 + w_prev * pred_x0_prev
+            img = ratio * img + phi * d
+            pred_x0_prev = pred_x0
+
+            if callback:
+                img = callback(i, img, pred_x0)
+            if img_callback:
+                img_callback(pred_x0, i)
+            index = S - i - 1
+            if index % log_every_t == 0 or index == S - 1:
+                intermediates["x_inter"].append(img)
+                intermediates["pred_x0"].append(pred_x0)
+
+        return img, intermediates
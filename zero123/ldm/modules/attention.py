@@ -33,6 +33,57 @@ def init_(tensor):
     return tensor
 
 
+# attention backends
+ATTENTION_BACKENDS = ("naive", "chunked", "sdpa")
+
+
+def set_attention_backend(model, name, chunk_size=1024):
+    """
+    Select how the CrossAttention, SpatialSelfAttention and QKVAttention modules
+    of model compute softmax(q k^T * scale) v:
+    naive:   materializes the full similarity matrix (the original code),
+    chunked: processes chunk_size queries at a time,
+    sdpa:    torch.nn.functional.scaled_dot_product_attention (torch >= 2.0).
+    :return: the number of attention modules.
+    """
+    if name not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {name}, choose from {ATTENTION_BACKENDS}")
+    if name == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        raise ValueError("The sdpa attention backend requires torch >= 2.0")
+    count = 0
+    for module in model.modules():
+        if hasattr(module, "attention_backend"):
+            module.attention_backend = name
+            module.attention_chunk_size = chunk_size
+            count += 1
+    print(f"{model.__class__.__name__}: {name} attention backend in {count} modules")
+    return count
+
+
+def attention(q, k, v, scale, mask=None, backend="chunked", chunk_size=1024):
+    """
+    Memory-efficient softmax(q k^T * scale) v with the chunked or sdpa backend.
+    :param q: a [B x N x D] Tensor of queries.
+    :param k: a [B x M x D] Tensor of keys.
+    :param v: a [B x M x Dv] Tensor of values.
+    :param mask: an optional boolean [B x 1 x M] Tensor, True where attending.
+    :return: a [B x N x Dv] Tensor.
+    """
+    if backend == "sdpa":
+        # sdpa scales by 1 / sqrt(D)
+        q = q * (scale * math.sqrt(q.shape[-1]))
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask)
+
+    out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+    for i in range(0, q.shape[1], chunk_size):
+        sim = einsum('b i d, b j d -> b i j', q[:, i:i + chunk_size], k) * scale
+        if exists(mask):
+            sim.masked_fill_(~mask, -torch.finfo(sim.dtype).max)
+        attn = sim.softmax(dim=-1, dtype=torch.float32).type(v.dtype)
+        out[:, i:i + chunk_size] = einsum('b i j, b j d -> b i d', attn, v)
+    return out
+
+
 # feedforward
 class GEGLU(nn.Module):
     def __init__(self, dim_in, dim_out):
@@ -122,6 +173,9 @@ class SpatialSelfAttention(nn.Module):
                                         kernel_size=1,
                                         stride=1,
                                         padding=0)
+        # see set_attention_backend
+        self.attention_backend = "naive"
+        self.attention_chunk_size = 1024
 
     def forward(self, x):
         h_ = x
@@ -132,6 +186,13 @@ class SpatialSelfAttention(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
+        if self.attention_backend != "naive":
+            q, k = map(lambda t: rearrange(t, 'b c h w -> b (h w) c'), (q, k))
+            v = rearrange(v, 'b c h w -> b (h w) c')
+            h_ = attention(q, k, v, int(c)**(-0.5), backend=self.attention_backend,
+                           chunk_size=self.attention_chunk_size)
+            h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h)
+            return x+self.proj_out(h_)
         q = rearrange(q, 'b c h w -> b (h w) c')
         k = rearrange(k, 'b c h w -> b c (h w)')
         w_ = torch.einsum('bij,bjk->bik', q, k)
@@ -166,10 +227,23 @@ class CrossAttention(nn.Module):
             nn.Linear(inner_dim, query_dim),
             nn.Dropout(dropout)
         )
+        # to_q and to_k get no gradients on this path, turn it off for DDP with
+        # find_unused_parameters=False (main.py does)
+        self.single_token_fast_path = True
+        # see set_attention_backend
+        self.attention_backend = "naive"
+        self.attention_chunk_size = 1024
 
     def forward(self, x, context=None, mask=None):
         h = self.heads
 
+        if exists(context) and context.shape[1] == 1 and not exists(mask) \
+                and self.single_token_fast_path:
+            # the softmax over a single key is 1, every query gets the value of the
+            # context token
+            out = self.to_out[0](self.to_v(context)).expand(-1, x.shape[1], -1)
+            return self.to_out[1](out)
+
         q = self.to_q(x)
         context = default(context, x)
         k = self.to_k(context)
@@ -177,6 +251,14 @@ class CrossAttention(nn.Module):
 
         q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
 
+        if self.attention_backend != "naive":
+            if exists(mask):
+                mask = repeat(rearrange(mask, 'b ... -> b (...)'), 'b j -> (b h) () j', h=h)
+            out = attention(q, k, v, self.scale, mask=mask, backend=self.attention_backend,
+                            chunk_size=self.attention_chunk_size)
+            out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+            return self.to_out(out)
+
         sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
 
         if exists(mask):
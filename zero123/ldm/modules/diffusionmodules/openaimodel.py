@@ -7,7 +7,11 @@ import numpy as np
 import torch as th
 import torch.nn as nn
 import torch.nn.functional as F
-from ldm.modules.attention import SpatialTransformer
+from ldm.modules.attention import (
+    SpatialTransformer,
+    attention,
+    set_attention_backend,
+)
 from ldm.modules.diffusionmodules.util import (
     avg_pool_nd,
     checkpoint,
@@ -17,7 +21,7 @@ from ldm.modules.diffusionmodules.util import (
     timestep_embedding,
     zero_module,
 )
-from ldm.util import exists
+from ldm.util import default, exists
 
 
 # dummy replace
@@ -367,6 +371,9 @@ class QKVAttentionLegacy(nn.Module):
     def __init__(self, n_heads):
         super().__init__()
         self.n_heads = n_heads
+        # see ldm.modules.attention.set_attention_backend
+        self.attention_backend = "naive"
+        self.attention_chunk_size = 1024
 
     def forward(self, qkv):
         """
@@ -378,6 +385,16 @@ class QKVAttentionLegacy(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.reshape(bs * self.n_heads, ch * 3, length).split(ch, dim=1)
+        if self.attention_backend != "naive":
+            a = attention(
+                q.transpose(1, 2),
+                k.transpose(1, 2),
+                v.transpose(1, 2),
+                ch**-0.5,
+                backend=self.attention_backend,
+                chunk_size=self.attention_chunk_size,
+            )
+            return a.transpose(1, 2).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts", q * scale, k * scale
@@ -399,6 +416,9 @@ class QKVAttention(nn.Module):
     def __init__(self, n_heads):
         super().__init__()
         self.n_heads = n_heads
+        # see ldm.modules.attention.set_attention_backend
+        self.attention_backend = "naive"
+        self.attention_chunk_size = 1024
 
     def forward(self, qkv):
         """
@@ -410,6 +430,20 @@ class QKVAttention(nn.Module):
         assert width % (3 * self.n_heads) == 0
         ch = width // (3 * self.n_heads)
         q, k, v = qkv.chunk(3, dim=1)
+        if self.attention_backend != "naive":
+            q, k, v = (
+                t.reshape(bs * self.n_heads, ch, length).transpose(1, 2)
+                for t in (q, k, v)
+            )
+            a = attention(
+                q,
+                k,
+                v,
+                ch**-0.5,
+                backend=self.attention_backend,
+                chunk_size=self.attention_chunk_size,
+            )
+            return a.transpose(1, 2).reshape(bs, -1, length)
         scale = 1 / math.sqrt(math.sqrt(ch))
         weight = th.einsum(
             "bct,bcs->bts",
@@ -453,6 +487,12 @@ class UNetModel(nn.Module):
     :param resblock_updown: use residual blocks for up/downsampling.
     :param use_new_attention_order: use a different attention pattern for potentially
                                     increased efficiency.
+    :param attention_backend: "naive", "chunked" or "sdpa", see
+                              ldm.modules.attention.set_attention_backend.
+                              Applies to the attention modules of this model.
+    :param attention_chunk_size: queries per chunk of the chunked backend.
+    :param checkpoint_policy: if specified (as a dict), overrides use_checkpoint
+                              with set_checkpoint_policy(**checkpoint_policy).
     """
 
     def __init__(
@@ -483,6 +523,9 @@ class UNetModel(nn.Module):
         legacy=True,
         disable_self_attentions=None,
         num_attention_blocks=None,
+        attention_backend=None,
+        attention_chunk_size=1024,
+        checkpoint_policy=None,
     ):
         super().__init__()
         if use_spatial_transformer:
@@ -792,6 +835,65 @@ class UNetModel(nn.Module):
                 # nn.LogSoftmax(dim=1)  # change to cross_entropy and produce non-normalized logits
             )
 
+        if attention_backend is not None:
+            set_attention_backend(self, attention_backend, attention_chunk_size)
+        if checkpoint_policy is not None:
+            self.set_checkpoint_policy(**checkpoint_policy)
+
+    def block_levels(self):
+        """
+        Yield (level, block) for the input, middle and output blocks in forward
+        order, where level is the index into channel_mult of the block's input
+        resolution (the middle block is on the last level).
+        """
+        levels = [0]
+        for level in range(len(self.channel_mult)):
+            levels += [level] * self.num_res_blocks[level]
+            if level != len(self.channel_mult) - 1:
+                levels.append(level)
+        yield from zip(levels, self.input_blocks)
+        yield len(self.channel_mult) - 1, self.middle_block
+        levels = [
+            level
+            for level in reversed(range(len(self.channel_mult)))
+            for _ in range(self.num_res_blocks[level] + 1)
+        ]
+        yield from zip(levels, self.output_blocks)
+
+    def set_checkpoint_policy(self, levels=None, block_types=None, every=1):
+        """
+        Choose which blocks recompute their activations in the backward pass.
+        :param levels: channel_mult indices to checkpoint, None for all levels.
+        :param block_types: subset of ("resblock", "attention"), None for both.
+            "attention" covers AttentionBlocks and the BasicTransformerBlocks
+            of SpatialTransformers.
+        :param every: only checkpoint every k-th of the selected blocks.
+        :return: the number of checkpointed blocks.
+        """
+        block_types = default(block_types, ("resblock", "attention"))
+        count, selected = 0, 0
+        for level, block in self.block_levels():
+            for layer in block:
+                if isinstance(layer, (ResBlock, AttentionBlock)):
+                    modules, attr = [layer], "use_checkpoint"
+                elif isinstance(layer, SpatialTransformer):
+                    modules, attr = layer.transformer_blocks, "checkpoint"
+                else:
+                    continue
+                block_type = "resblock" if isinstance(layer, ResBlock) else "attention"
+                matches = block_type in block_types and (
+                    levels is None or level in levels
+                )
+                for module in modules:
+                    flag = False
+                    if matches:
+                        flag = selected % every == 0
+                        selected += 1
+                    setattr(module, attr, flag)
+                    count += flag
+        print(f"{self.__class__.__name__}: checkpointing {count} blocks")
+        return count
+
     def convert_to_fp16(self):
         """
         Convert the torso of the model to float16.
@@ -196,6 +196,35 @@ def mean_flat(tensor):
     return tensor.mean(dim=list(range(1, len(tensor.shape))))
 
 
+def aggregate_views(model_output, cond_counts):
+    """
+    Softmax-weighted sum of the per-view predictions of every sample.
+    The first half of the channels of model_output holds the noise predicted
+    from each conditioning view, the second half the logits of its per-element
+    weight. The views of sample i are the cond_counts[i] consecutive rows
+    starting at sum(cond_counts[:i]). Uses no host synchronization.
+    :param model_output: a [sum(cond_counts) x 2C x ...] Tensor.
+    :param cond_counts: an [N] Tensor of views per sample.
+    :return: an [N x C x ...] Tensor.
+    """
+    noise, logits = model_output.chunk(2, dim=1)
+    n = cond_counts.shape[0]
+    segments = torch.repeat_interleave(
+        torch.arange(n, device=model_output.device),
+        cond_counts.to(model_output.device, torch.long),
+        output_size=model_output.shape[0],
+    )
+    shape = (n,) + logits.shape[1:]
+    # the softmax is shift invariant, so the segment max needs no gradient
+    index = segments.view(-1, *([1] * (logits.dim() - 1))).expand_as(logits)
+    logits_max = logits.new_full(shape, float("-inf")).scatter_reduce(
+        0, index, logits.detach(), reduce="amax", include_self=True)
+    weights = torch.exp(logits - logits_max[segments])
+    numerator = noise.new_zeros(shape).index_add(0, segments, weights * noise)
+    denominator = logits.new_zeros(shape).index_add(0, segments, weights)
+    return numerator / denominator
+
+
 def normalization(channels):
     """
     Make a standard normalization layer.
@@ -74,3 +74,123 @@ class LitEma(nn.Module):
         """
         for c_param, param in zip(self.collected_params, parameters):
             param.data.copy_(c_param.data)
+
+
+class FlatEma(nn.Module):
+    """
+    EMA of the trainable parameters of a model, kept in one contiguous buffer.
+    Has the same interface and state_dict layout as LitEma, but updates all
+    shadow weights with a few multi-tensor ops, only every `update_every`
+    calls (with the decay compounded accordingly), and can keep them on
+    another device than the model, e.g. device="cpu" with pin_memory=True.
+    Shadow weights on an explicit device are not moved along with the module.
+    """
+    def __init__(self, model, decay=0.9999, use_num_upates=True, update_every=1,
+                 device=None, pin_memory=False):
+        super().__init__()
+        if decay < 0.0 or decay > 1.0:
+            raise ValueError('Decay must be between 0 and 1')
+        if update_every < 1:
+            raise ValueError('update_every must be at least 1')
+
+        self.register_buffer('decay', torch.tensor(decay, dtype=torch.float32))
+        self.register_buffer('num_updates', torch.tensor(0,dtype=torch.int) if use_num_upates
+                             else torch.tensor(-1,dtype=torch.int))
+        self.update_every = update_every
+        self.device = device
+        self.steps = 0
+
+        self.m_name2s_name = {}
+        params = []
+        for name, p in model.named_parameters():
+            if p.requires_grad:
+                #remove as '.'-character is not allowed in buffers
+                self.m_name2s_name.update({name:name.replace('.','')})
+                params.append(p)
+        self.s_names = list(self.m_name2s_name.values())
+        self.shapes = [p.shape for p in params]
+
+        flat = torch.empty(sum(p.numel() for p in params), dtype=params[0].dtype,
+                           device=device if device is not None else params[0].device)
+        if pin_memory:
+            flat = flat.pin_memory()
+        self._set_flat(flat)
+        with torch.no_grad():
+            for s_param, p in zip(self.shadow_params, params):
+                s_param.copy_(p)
+
+        self._register_state_dict_hook(FlatEma._state_dict_hook)
+        self._register_load_state_dict_pre_hook(self._load_state_dict_pre_hook)
+        self.collected_params = []
+
+    def _set_flat(self, flat):
+        self.flat = flat
+        views = torch.split(flat, [shape.numel() for shape in self.shapes])
+        self.shadow_params = [v.view(shape) for v, shape in zip(views, self.shapes)]
+
+    def _apply(self, fn, *args, **kwargs):
+        super()._apply(fn, *args, **kwargs)
+        if self.device is None:
+            self._set_flat(fn(self.flat))
+        return self
+
+    @staticmethod
+    def _state_dict_hook(module, state_dict, prefix, local_metadata):
+        for s_name, s_param in zip(module.s_names, module.shadow_params):
+            state_dict[prefix + s_name] = s_param.detach()
+        return state_dict
+
+    def _load_state_dict_pre_hook(self, state_dict, prefix, local_metadata, strict,
+                                  missing_keys, unexpected_keys, error_msgs):
+        with torch.no_grad():
+            for s_name, s_param in zip(self.s_names, self.shadow_params):
+                key = prefix + s_name
+                if key in state_dict:
+                    value = state_dict.pop(key)
+                    if value.shape != s_param.shape:
+                        error_msgs.append(f'size mismatch for {key}: copying a param with shape '
+                                          f'{value.shape}, the shape in current model is {s_param.shape}.')
+                        continue
+                    s_param.copy_(value)
+                elif strict:
+                    missing_keys.append(key)
+
+    def _trainable(self, model):
+        return [p for p in model.parameters() if p.requires_grad]
+
+    def forward(self, model):
+        self.steps += 1
+        if self.steps % self.update_every != 0:
+            return
+
+        decay = self.decay.item()
+        if self.num_updates >= 0:
+            self.num_updates += 1
+            num_updates = self.num_updates.item()
+            decay = min(decay, (1 + num_updates) / (10 + num_updates))
+        decay = decay ** self.update_every
+
+        with torch.no_grad():
+            params = self._trainable(model)
+            if params[0].device != self.flat.device or params[0].dtype != self.flat.dtype:
+                params = [p.to(self.flat.device, self.flat.dtype) for p in params]
+            torch._foreach_mul_(self.shadow_params, decay)
+            torch._foreach_add_(self.shadow_params, params, alpha=1.0 - decay)
+
+    def copy_to(self, model):
+        with torch.no_grad():
+            for p, s_param in zip(self._trainable(model), self.shadow_params):
+                p.copy_(s_param, non_blocking=True)
+
+    def store(self, parameters):
+        """
+        Save the current parameters for restoring later.
+        """
+        self.collected_params = [param.clone() for param in parameters]
+
+    def restore(self, parameters):
+        """
+        Restore the parameters stored with the `store` method.
+        """
+        for c_param, param in zip(self.collected_params, parameters):
+            param.data.copy_(c_param.data)
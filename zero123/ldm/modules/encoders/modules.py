@@ -4,10 +4,13 @@ import numpy as np
 from functools import partial
 import kornia
 
-from ldm.modules.x_transformer import Encoder, TransformerWrapper  # TODO: can we directly rely on lucidrains code and simply add this as a reuirement? --> test
 from ldm.util import default
 import clip
 
+# transformers, the x_transformer and the face ID network are only imported by
+# the encoders that use them, so that importing this module for the CLIP image
+# embedder stays cheap
+
 
 class AbstractEncoder(nn.Module):
     def __init__(self):
@@ -107,6 +110,7 @@ class TransformerEmbedder(AbstractEncoder):
     """Some transformer encoder layers"""
     def __init__(self, n_embed, n_layer, vocab_size, max_seq_len=77, device="cuda"):
         super().__init__()
+        from ldm.modules.x_transformer import Encoder, TransformerWrapper  # TODO: can we directly rely on lucidrains code and simply add this as a reuirement? --> test
         self.device = device
         self.transformer = TransformerWrapper(num_tokens=vocab_size, max_seq_len=max_seq_len,
                                               attn_layers=Encoder(dim=n_embed, depth=n_layer))
@@ -155,6 +159,7 @@ class BERTEmbedder(AbstractEncoder):
         self.use_tknz_fn = use_tokenizer
         if self.use_tknz_fn:
             self.tknz_fn = BERTTokenizer(vq_interface=False, max_length=max_seq_len)
+        from ldm.modules.x_transformer import Encoder, TransformerWrapper
         self.device = device
         self.transformer = TransformerWrapper(num_tokens=vocab_size, max_seq_len=max_seq_len,
                                               attn_layers=Encoder(dim=n_embed, depth=n_layer),
@@ -173,8 +178,6 @@ class BERTEmbedder(AbstractEncoder):
         return self(text)
 
 
-from transformers import T5Tokenizer, T5EncoderModel, CLIPTokenizer, CLIPTextModel
-
 def disabled_train(self, mode=True):
     """Overwrite model.train with this function to make sure train/eval mode
     does not change anymore."""
@@ -185,6 +188,7 @@ class FrozenT5Embedder(AbstractEncoder):
     """Uses the T5 transformer encoder for text"""
     def __init__(self, version="google/t5-v1_1-large", device="cuda", max_length=77):  # others are google/t5-v1_1-xl and google/t5-v1_1-xxl
         super().__init__()
+        from transformers import T5Tokenizer, T5EncoderModel
         self.tokenizer = T5Tokenizer.from_pretrained(version)
         self.transformer = T5EncoderModel.from_pretrained(version)
         self.device = device
@@ -209,12 +213,12 @@ class FrozenT5Embedder(AbstractEncoder):
     def encode(self, text):
         return self(text)
 
-from ldm.thirdp.psp.id_loss import IDFeatures
 import kornia.augmentation as K
 
 class FrozenFaceEncoder(AbstractEncoder):
     def __init__(self, model_path, augment=False):
         super().__init__()
+        from ldm.thirdp.psp.id_loss import IDFeatures
         self.loss_fn = IDFeatures(model_path)
         # face encoder is frozen
         for p in self.loss_fn.parameters():
@@ -255,6 +259,7 @@ class FrozenCLIPEmbedder(AbstractEncoder):
     """Uses the CLIP transformer encoder for text (from huggingface)"""
     def __init__(self, version="openai/clip-vit-large-patch14", device="cuda", max_length=77):  # clip-vit-base-patch32
         super().__init__()
+        from transformers import CLIPTokenizer, CLIPTextModel
         self.tokenizer = CLIPTokenizer.from_pretrained(version)
         self.transformer = CLIPTextModel.from_pretrained(version)
         self.device = device
@@ -280,13 +285,13 @@ class FrozenCLIPEmbedder(AbstractEncoder):
         return self(text)
 
 import torch.nn.functional as F
-from transformers import CLIPVisionModel
 class ClipImageProjector(AbstractEncoder):
     """
         Uses the CLIP image encoder.
         """
     def __init__(self, version="openai/clip-vit-large-patch14", max_length=77):  # clip-vit-base-patch32
         super().__init__()
+        from transformers import CLIPVisionModel
         self.model = CLIPVisionModel.from_pretrained(version)
         self.model.train()
         self.max_length = max_length   # TODO: typical value?
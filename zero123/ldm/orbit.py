@@ -0,0 +1,181 @@
+"""Novel views of one input image for many relative poses.
+
+`encode_input` runs the CLIP image encoder and the VAE encoder on the input
+once. `sample_poses` then builds the `cc_projection` conditioning of all poses
+as one batch and samples them in DDIM runs of at most `max_batch` rows, so a
+36-view turntable costs one encoder pass and a few batched sampling loops
+instead of 36 of each. Frames are yielded as soon as their chunk is decoded.
+
+A pose is `(elevation, azimuth, radius)` relative to the input view, with the
+angles in radians, as in `InferenceEngine.sample_pose` (ldm/engine.py), which
+the demos call.
+
+Usage:
+    python -m ldm.orbit --config configs/sd-objaverse-finetune-c_concat-256.yaml \
+        --ckpt 105000.ckpt --image cond.png --n_views 36 --out_dir orbit
+"""
+
+import math
+import os
+from contextlib import nullcontext
+
+import fire
+import numpy as np
+import torch
+from einops import rearrange
+from ldm.models.diffusion.ddim import DDIMSampler
+from PIL import Image
+
+
+def pose_embedding(elevation, azimuth, radius):
+    return [elevation, math.sin(azimuth), math.cos(azimuth), radius]
+
+
+def turntable(n_views=36, elevation=0.0, radius=0.0):
+    """Poses of `n_views` cameras evenly spaced in azimuth around the object."""
+    return [(elevation, 2 * math.pi * i / n_views, radius) for i in range(n_views)]
+
+
+def precision_scope(precision):
+    return torch.autocast("cuda") if precision == "autocast" else nullcontext()
+
+
+@torch.no_grad()
+def encode_input(model, input_im, precision="fp32"):
+    """Encode a `[1, 3, H, W]` input image in [-1, 1] for `sample_poses`."""
+    input_im = input_im.to(model.device)
+    with precision_scope(precision), model.ema_scope():
+        clip_emb = model.get_learned_conditioning(input_im).float()
+        z = model.encode_first_stage(input_im).mode().float()
+    # the multi-view UNet expects the latent of the reference view next to the
+    # latent of the conditioning view, which is the same view here
+    concat_channels = model.model.diffusion_model.in_channels - z.shape[1]
+    return {
+        "clip_emb": clip_emb.reshape(1, 1, -1),
+        "c_concat": z.repeat(1, concat_channels // z.shape[1], 1, 1),
+    }
+
+
+@torch.no_grad()
+def pose_conditioning(model, encoded, poses, n_samples=1):
+    """Conditioning of `n_samples` rows per pose, in pose order."""
+    T = torch.tensor([pose_embedding(*pose) for pose in poses], device=model.device)
+    T = T.repeat_interleave(n_samples, dim=0)[:, None, :]
+    rows = T.shape[0]
+    clip_emb = encoded["clip_emb"].expand(rows, -1, -1)
+    c = model.cc_projection(torch.cat([clip_emb, T.to(clip_emb.dtype)], dim=-1))
+    return {
+        "c_crossattn": [c],
+        "c_concat": [encoded["c_concat"].expand(rows, -1, -1, -1)],
+    }
+
+
+@torch.no_grad()
+def sample_poses(
+    model,
+    encoded,
+    poses,
+    sampler=None,
+    n_samples=1,
+    ddim_steps=50,
+    scale=3.0,
+    ddim_eta=1.0,
+    precision="fp32",
+    max_batch=16,
+):
+    """Yield `(pose_index, images)` for every pose of `poses`.
+
+    `images` holds the `[n_samples, 3, H, W]` samples of the pose in [0, 1] on
+    the CPU. The poses are sampled in chunks of at most `max_batch` rows (twice
+    that with classifier-free guidance) and yielded as each chunk finishes.
+    """
+    sampler = sampler or DDIMSampler(model)
+    z = encoded["c_concat"]
+    shape = [4, z.shape[2], z.shape[3]]
+    poses_per_chunk = max(1, max_batch // n_samples)
+
+    for start in range(0, len(poses), poses_per_chunk):
+        chunk = poses[start : start + poses_per_chunk]
+        with precision_scope(precision), model.ema_scope():
+            cond = pose_conditioning(model, encoded, chunk, n_samples)
+            rows = len(chunk) * n_samples
+            uc = None
+            if scale != 1.0:
+                uc = {
+                    "c_crossattn": [torch.zeros_like(cond["c_crossattn"][0])],
+                    "c_concat": [torch.zeros_like(cond["c_concat"][0])],
+                }
+            samples, _ = sampler.sample(
+                S=ddim_steps,
+                conditioning=cond,
+                cond_counts=torch.ones(rows, dtype=torch.long, device=model.device),
+                batch_size=rows,
+                shape=shape,
+                verbose=False,
+                unconditional_guidance_scale=scale,
+                unconditional_conditioning=uc,
+                eta=ddim_eta,
+            )
+            x_samples = model.decode_first_stage(samples)
+        x_samples = torch.clamp((x_samples.float() + 1.0) / 2.0, 0.0, 1.0).cpu()
+        for i in range(len(chunk)):
+            yield start + i, x_samples[i * n_samples : (i + 1) * n_samples]
+
+
+def main(
+    config,
+    ckpt,
+    image,
+    out_dir="orbit",
+    n_views=36,
+    elevation=0.0,
+    radius=0.0,
+    n_samples=1,
+    ddim_steps=50,
+    scale=3.0,
+    ddim_eta=1.0,
+    precision="fp32",
+    max_batch=16,
+    size=256,
+    device="cuda",
+    sampler="ddim",
+):
+    """Render a turntable of an image whose background is already removed.
+
+    :param elevation: elevation of the orbit relative to the input, in degrees.
+    :param sampler: "ddim" or "dpmpp_2m", see `ldm.engine.SAMPLERS`.
+    """
+    from ldm.checkpoint import load_model
+    from ldm.engine import SAMPLERS
+    from omegaconf import OmegaConf
+
+    model = load_model(OmegaConf.load(config), ckpt, device)
+    im = Image.open(image).convert("RGBA").resize([size, size], Image.LANCZOS)
+    im = np.asarray(im, dtype=np.float32) / 255.0
+    im = im[..., 3:] * im[..., :3] + (1.0 - im[..., 3:])  # composite on white
+    input_im = torch.from_numpy(im).permute(2, 0, 1)[None] * 2 - 1
+
+    os.makedirs(out_dir, exist_ok=True)
+    encoded = encode_input(model, input_im, precision)
+    poses = turntable(n_views, math.radians(elevation), radius)
+    for index, images in sample_poses(
+        model,
+        encoded,
+        poses,
+        sampler=SAMPLERS[sampler](model),
+        n_samples=n_samples,
+        ddim_steps=ddim_steps,
+        scale=scale,
+        ddim_eta=ddim_eta,
+        precision=precision,
+        max_batch=max_batch,
+    ):
+        for k, x in enumerate(images):
+            x = 255.0 * rearrange(x.numpy(), "c h w -> h w c")
+            path = os.path.join(out_dir, f"{index:03d}_{k}.png")
+            Image.fromarray(x.astype(np.uint8)).save(path)
+        print(f"Wrote view {index + 1}/{len(poses)}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
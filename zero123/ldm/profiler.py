@@ -0,0 +1,104 @@
+"""Lightweight per-stage timing of the training step.
+
+The model and the callbacks in main.py wrap their stages in
+`profiler.stage(name)`. While the module level `profiler` is disabled (the
+default) this returns a shared no-op context, so the hooks cost one attribute
+lookup. When enabled, every stage records its wall time and, on GPU, a pair of
+CUDA events whose elapsed time is only read in `summary`, so recording never
+synchronizes the device. Stages entered inside another stage (e.g. the VAE
+encode of `log_images` inside "image_logger") are folded into the outer one.
+Nesting is tracked per thread, and background threads that should not count
+towards the training step (e.g. the async ImageLogger) run under `paused()`.
+"""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+_NULL = nullcontext()
+
+
+class StageProfiler:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.wall = defaultdict(list)
+        self.events = defaultdict(list)
+        self.steps = 0
+
+    def stage(self, name):
+        if not self.enabled or getattr(self._local, "active", False):
+            return _NULL
+        return self._record(name)
+
+    @contextmanager
+    def paused(self):
+        """Skip all stages entered by the calling thread."""
+        active = getattr(self._local, "active", False)
+        self._local.active = True
+        try:
+            yield
+        finally:
+            self._local.active = active
+
+    @contextmanager
+    def _record(self, name):
+        self._local.active = True
+        events = None
+        if torch.cuda.is_available():
+            events = (
+                torch.cuda.Event(enable_timing=True),
+                torch.cuda.Event(enable_timing=True),
+            )
+            events[0].record()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.wall[name].append(time.perf_counter() - start)
+            if events is not None:
+                events[1].record()
+                self.events[name].append(events)
+            self._local.active = False
+
+    def add(self, name, seconds):
+        """Record a host-only stage that was timed by the caller."""
+        if self.enabled:
+            self.wall[name].append(seconds)
+
+    def step(self):
+        if self.enabled:
+            self.steps += 1
+
+    def summary(self):
+        """Return `{stage: stats}` for the steps since the last call and reset.
+
+        The stats are the number of calls, the mean wall and device time per
+        call and the wall time per training step, in milliseconds.
+        """
+        if self.events:
+            torch.cuda.synchronize()
+        steps = max(self.steps, 1)
+        summary = {}
+        for name, wall in self.wall.items():
+            stats = {
+                "count": len(wall),
+                "wall_ms": 1e3 * sum(wall) / len(wall),
+                "wall_ms_per_step": 1e3 * sum(wall) / steps,
+            }
+            events = self.events.get(name)
+            if events:
+                device = [start.elapsed_time(end) for start, end in events]
+                stats["device_ms"] = sum(device) / len(device)
+            summary[name] = stats
+        self.reset()
+        return summary
+
+
+profiler = StageProfiler()
@@ -10,12 +10,9 @@ from PIL import Image, ImageDraw, ImageFont
 
 import os
 import numpy as np
-import matplotlib.pyplot as plt
 from PIL import Image
 import torch
 import time
-import cv2
-from carvekit.api.high import HiInterface
 import PIL
 
 def pil_rectangle_crop(im):
@@ -45,6 +42,9 @@ def add_margin(pil_img, color, size=256):
 
 
 def create_carvekit_interface():
+    # imported here so that only the entry points that remove backgrounds pay for it
+    from carvekit.api.high import HiInterface
+
     # Check doc strings for more information
     interface = HiInterface(object_type="object",  # Can be "object" or "hairs-like".
                             batch_size_seg=5,
@@ -69,6 +69,17 @@ def load_and_preprocess(interface, input_im):
     image = input_im.convert('RGB')
 
     image_without_background = interface([image])[0]
+    return crop_foreground(image, image_without_background)
+
+
+def crop_foreground(image, image_without_background):
+    '''
+    :param image (PIL Image) RGB input of the background removal.
+    :param image_without_background (PIL Image) carvekit output for `image`.
+    :return image (256, 256, 3) uint8 array, the foreground recentered on white.
+    '''
+    import cv2
+
     image_without_background = np.array(image_without_background)
     est_seg = image_without_background > 127
     image = np.array(image)
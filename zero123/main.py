@@ -4,8 +4,10 @@ import csv
 import datetime
 import glob
 import importlib
+import json
 import os
 import sys
+import threading
 import time
 from functools import partial
 
@@ -13,7 +15,10 @@ import numpy as np
 import pytorch_lightning as pl
 import torch
 import torchvision
+from ldm.checkpoint import ShardedCheckpointWriter
 from ldm.data.base import Txt2ImgIterableBaseDataset
+from ldm.modules.ema import FlatEma
+from ldm.profiler import profiler
 from ldm.util import instantiate_from_config
 from omegaconf import OmegaConf
 from packaging import version
@@ -382,6 +387,17 @@ class SetupCallback(Callback):
                     pass
 
 
+def batch_to_device(batch, device):
+    """Copy the tensors of a (nested) batch to `device`."""
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, copy=True)
+    if isinstance(batch, dict):
+        return {k: batch_to_device(v, device) for k, v in batch.items()}
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(batch_to_device(v, device) for v in batch)
+    return batch
+
+
 class ImageLogger(Callback):
     def __init__(
         self,
@@ -395,7 +411,15 @@ class ImageLogger(Callback):
         log_first_step=False,
         log_images_kwargs=None,
         log_all_val=False,
+        async_device=None,
     ):
+        """
+        :param async_device: if set (e.g. "cuda:1" or "cpu"), rank zero samples
+            the training images in a background thread on a copy of the model
+            kept on this device. Each log only costs copying the trainable
+            weights and the batch over; a log that comes due while the previous
+            one is still sampling is skipped, so logging never waits for it.
+        """
         super().__init__()
         self.rescale = rescale
         self.batch_freq = batch_frequency
@@ -412,17 +436,19 @@ class ImageLogger(Callback):
         self.log_images_kwargs = log_images_kwargs if log_images_kwargs else {}
         self.log_first_step = log_first_step
         self.log_all_val = log_all_val
+        self.async_device = async_device
+        self.shadow = None
+        self.worker = None
+        self.skipped_logs = 0
 
     @rank_zero_only
-    def _testtube(self, pl_module, images, batch_idx, split):
+    def _testtube(self, pl_module, images, global_step, split):
         for k in images:
             grid = torchvision.utils.make_grid(images[k])
             grid = (grid + 1.0) / 2.0  # -1,1 -> 0,1; c,h,w
 
             tag = f"{split}/{k}"
-            pl_module.logger.experiment.add_image(
-                tag, grid, global_step=pl_module.global_step
-            )
+            pl_module.logger.experiment.add_image(tag, grid, global_step=global_step)
 
     @rank_zero_only
     def log_local(self, save_dir, split, images, global_step, current_epoch, batch_idx):
@@ -454,41 +480,137 @@ class ImageLogger(Callback):
             and callable(pl_module.log_images)
             and self.max_images > 0
         ):
-            logger = type(pl_module.logger)
+            if self.async_device is not None and split == "train":
+                with profiler.stage("image_logger"):
+                    self.log_img_async(pl_module, batch, batch_idx, split)
+                return
 
             is_train = pl_module.training
             if is_train:
                 pl_module.eval()
 
-            with torch.no_grad():
-                images = pl_module.log_images(
-                    batch, split=split, **self.log_images_kwargs
+            with profiler.stage("image_logger"):
+                self.sample_and_log(
+                    pl_module,
+                    pl_module,
+                    batch,
+                    batch_idx,
+                    split,
+                    pl_module.global_step,
+                    pl_module.current_epoch,
                 )
 
-            for k in images:
-                N = min(images[k].shape[0], self.max_images)
-                images[k] = images[k][:N]
-                if isinstance(images[k], torch.Tensor):
-                    images[k] = images[k].detach().cpu()
-                    if self.clamp:
-                        images[k] = torch.clamp(images[k], -1.0, 1.0)
+            if is_train:
+                pl_module.train()
 
-            self.log_local(
-                pl_module.logger.save_dir,
+    def sample_and_log(
+        self, model, pl_module, batch, batch_idx, split, global_step, current_epoch
+    ):
+        """Sample `model.log_images` and write them for the logger of `pl_module`."""
+        with torch.no_grad():
+            images = model.log_images(batch, split=split, **self.log_images_kwargs)
+
+        for k in images:
+            N = min(images[k].shape[0], self.max_images)
+            images[k] = images[k][:N]
+            if isinstance(images[k], torch.Tensor):
+                images[k] = images[k].detach().cpu()
+                if self.clamp:
+                    images[k] = torch.clamp(images[k], -1.0, 1.0)
+
+        self.log_local(
+            pl_module.logger.save_dir,
+            split,
+            images,
+            global_step,
+            current_epoch,
+            batch_idx,
+        )
+
+        logger_log_images = self.logger_log_images.get(
+            type(pl_module.logger), lambda *args, **kwargs: None
+        )
+        logger_log_images(pl_module, images, global_step, split)
+
+    @torch.no_grad()
+    def snapshot(self, pl_module):
+        """Copy the current weights of `pl_module` into `self.shadow`."""
+        params = list(pl_module.parameters())
+        buffers = list(pl_module.buffers())
+        if self.shadow is None:
+            # pre-seed the deepcopy memo so the weights are copied straight to
+            # the target device instead of duplicated on the training device
+            memo = {id(pl_module.trainer): None}
+            for p in params:
+                memo[id(p)] = torch.nn.Parameter(
+                    p.detach().to(self.async_device, copy=True), requires_grad=False
+                )
+            for b in buffers:
+                memo[id(b)] = b.detach().to(self.async_device, copy=True)
+            for m in pl_module.modules():
+                if isinstance(m, FlatEma):
+                    # FlatEma keeps its weights and their views outside of the buffers
+                    flat = m.flat.detach().to(self.async_device, copy=True)
+                    memo[id(m.flat)] = flat
+                    views = torch.split(flat, [shape.numel() for shape in m.shapes])
+                    memo[id(m.shadow_params)] = [
+                        v.view(shape) for v, shape in zip(views, m.shapes)
+                    ]
+            self.shadow = copy.deepcopy(pl_module, memo).to(self.async_device)
+            self.shadow.eval()
+            return
+        # frozen weights never change, so only the trained ones and the
+        # buffers (e.g. the EMA weights) are copied again
+        for dst, src in zip(self.shadow.parameters(), params):
+            if src.requires_grad:
+                dst.copy_(src)
+        for dst, src in zip(self.shadow.buffers(), buffers):
+            dst.copy_(src)
+        for dst, src in zip(self.shadow.modules(), pl_module.modules()):
+            if isinstance(src, FlatEma):
+                dst.flat.copy_(src.flat)
+
+    @rank_zero_only
+    def log_img_async(self, pl_module, batch, batch_idx, split):
+        if self.worker is not None and self.worker.is_alive():
+            self.skipped_logs += 1
+            rank_zero_print(
+                f"ImageLogger: previous log still sampling, skipping step "
+                f"{pl_module.global_step} ({self.skipped_logs} skipped so far)"
+            )
+            return
+        self.snapshot(pl_module)
+        batch = batch_to_device(batch, self.async_device)
+        self.worker = threading.Thread(
+            target=self._run_worker,
+            args=(
+                pl_module,
+                batch,
+                batch_idx,
                 split,
-                images,
                 pl_module.global_step,
                 pl_module.current_epoch,
-                batch_idx,
-            )
-
-            logger_log_images = self.logger_log_images.get(
-                logger, lambda *args, **kwargs: None
-            )
-            logger_log_images(pl_module, images, pl_module.global_step, split)
+            ),
+            daemon=True,
+        )
+        self.worker.start()
 
-            if is_train:
-                pl_module.train()
+    def _run_worker(self, pl_module, *args):
+        device = torch.device(self.async_device)
+        try:
+            # the sampling of the worker is not part of the training step
+            with profiler.paused():
+                if device.type == "cuda":
+                    with torch.cuda.device(device):
+                        self.sample_and_log(self.shadow, pl_module, *args)
+                else:
+                    self.sample_and_log(self.shadow, pl_module, *args)
+        except Exception as e:
+            print(f"ImageLogger: background logging failed: {e!r}")
+
+    def on_train_end(self, trainer, pl_module):
+        if self.worker is not None:
+            self.worker.join()
 
     def check_frequency(self, check_idx):
         if ((check_idx % self.batch_freq) == 0 or (check_idx in self.log_steps)) and (
@@ -520,6 +642,137 @@ class ImageLogger(Callback):
                 self.log_gradients(trainer, pl_module, batch_idx=batch_idx)
 
 
+class StageProfilerCallback(Callback):
+    """Rolling per-stage timing of the training step, see ldm/profiler.py.
+
+    Every `every_n_steps` steps the mean wall / device time of the data wait,
+    VAE and CLIP encodes, UNet forward and backward, EMA update and image
+    logging is sent to the logger as `profile/<stage>_<stat>` and appended to
+    `<logdir>/profile.jsonl`. Enable with
+    `lightning.callbacks.stage_profiler.params.enabled: true`.
+    """
+
+    def __init__(self, logdir, every_n_steps=100, enabled=False):
+        super().__init__()
+        self.jsonl_path = os.path.join(logdir, "profile.jsonl")
+        self.every_n_steps = every_n_steps
+        self.enabled = enabled
+        self.batch_end = None
+
+    def on_train_start(self, trainer, pl_module):
+        profiler.enabled = self.enabled
+        profiler.reset()
+
+    def on_train_batch_start(
+        self, trainer, pl_module, batch, batch_idx, dataloader_idx
+    ):
+        if self.batch_end is not None:
+            profiler.add("data_wait", time.perf_counter() - self.batch_end)
+
+    def on_batch_end(self, trainer, pl_module):
+        # runs after on_train_batch_end of every callback and of the model
+        if not self.enabled:
+            return
+        profiler.step()
+        if profiler.steps >= self.every_n_steps:
+            self.log_summary(trainer, profiler.summary())
+        self.batch_end = time.perf_counter()
+
+    def on_validation_start(self, trainer, pl_module):
+        profiler.enabled = False
+
+    def on_validation_end(self, trainer, pl_module):
+        profiler.enabled = self.enabled
+        self.batch_end = None
+
+    def on_train_end(self, trainer, pl_module):
+        profiler.enabled = False
+
+    @rank_zero_only
+    def log_summary(self, trainer, summary):
+        metrics = {
+            f"profile/{stage}_{key}": value
+            for stage, stats in summary.items()
+            for key, value in stats.items()
+            if key != "count"
+        }
+        trainer.logger.log_metrics(metrics, step=trainer.global_step)
+        with open(self.jsonl_path, "a") as f:
+            f.write(json.dumps({"step": trainer.global_step, **summary}) + "\n")
+
+
+class CondViewBatchCallback(Callback):
+    """Epoch and fill statistics of a `CondViewBatchSampler` training loader.
+
+    Lightning only calls `set_epoch` on the sampler of a loader, not on its
+    batch sampler, so this sets the epoch of the data module's
+    `batch_sampler` at the start of every training epoch and logs its
+    `waste_stats` as `cond_view_batches/<stat>`. Does nothing unless
+    `cond_view_budget` is set in the data config.
+    """
+
+    def setup(self, trainer, pl_module, stage=None):
+        if getattr(trainer.datamodule, "cond_view_budget", None) is None:
+            return
+        connector = trainer.accelerator_connector
+        if connector.is_distributed and connector.replace_sampler_ddp:
+            raise ValueError(
+                "data.params.cond_view_budget shards its batches over the ranks "
+                "itself, set lightning.trainer.replace_sampler_ddp: False"
+            )
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        sampler = getattr(trainer.datamodule, "batch_sampler", None)
+        if sampler is None:
+            return
+        sampler.set_epoch(trainer.current_epoch)
+        self.log_stats(trainer, sampler.waste_stats())
+
+    @rank_zero_only
+    def log_stats(self, trainer, stats):
+        trainer.logger.log_metrics(
+            {f"cond_view_batches/{k}": v for k, v in stats.items()},
+            step=trainer.global_step,
+        )
+
+
+class ShardedCheckpoint(Callback):
+    """Checkpoints every `every_n_train_steps` without stalling the ranks.
+
+    Each rank copies its share of the checkpoint to pinned host memory and
+    writes it in a background thread, see ldm/checkpoint.py. With
+    `export_inference` rank zero also writes the EMA UNet and `cc_projection`
+    weights on their own. Enable with `lightning.callbacks.sharded_checkpoint`,
+    which turns off the step-based saves of the synchronous ModelCheckpoints.
+    """
+
+    def __init__(self, dirpath, every_n_train_steps=5000, export_inference=True):
+        super().__init__()
+        self.dirpath = dirpath
+        self.every_n_train_steps = every_n_train_steps
+        self.export_inference = export_inference
+        self.writer = None
+
+    def on_train_start(self, trainer, pl_module):
+        self.writer = ShardedCheckpointWriter(trainer.global_rank, trainer.world_size)
+
+    def on_train_batch_end(
+        self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx
+    ):
+        # same step convention as ModelCheckpoint.every_n_train_steps
+        if (trainer.global_step + 1) % self.every_n_train_steps != 0:
+            return
+        checkpoint = trainer.checkpoint_connector.dump_checkpoint()
+        inference_model = None
+        if self.export_inference and trainer.global_rank == 0:
+            inference_model = pl_module
+        self.writer.save(checkpoint, self.dirpath, trainer.global_step, inference_model)
+
+    def on_train_end(self, trainer, pl_module):
+        if self.writer is not None:
+            self.writer.wait()
+
+
 class CUDACallback(Callback):
     # see https://github.com/SeanNaren/minGPT/blob/master/mingpt/callback.py
     def on_train_epoch_start(self, trainer, pl_module):
@@ -622,7 +875,7 @@ class SingleImageLogger(Callback):
             if is_train:
                 pl_module.eval()
 
-            with torch.no_grad():
+            with profiler.stage("image_logger"), torch.no_grad():
                 images = pl_module.log_images(
                     batch, split=split, **self.log_images_kwargs
                 )
@@ -945,6 +1198,11 @@ if __name__ == "__main__":
                 },
             },
             "cuda_callback": {"target": "main.CUDACallback"},
+            "stage_profiler": {
+                "target": "main.StageProfilerCallback",
+                "params": {"logdir": logdir, "every_n_steps": 100, "enabled": False},
+            },
+            "cond_view_batches": {"target": "main.CondViewBatchCallback"},
         }
         if version.parse(pl.__version__) >= version.parse("1.4.0"):
             default_callbacks_cfg.update({"checkpoint_callback": modelckpt_cfg})
@@ -973,7 +1231,28 @@ if __name__ == "__main__":
             }
             default_callbacks_cfg.update(default_metrics_over_trainsteps_ckpt_dict)
 
+        if "sharded_checkpoint" in callbacks_cfg:
+            default_callbacks_cfg["sharded_checkpoint"] = {
+                "target": "main.ShardedCheckpoint",
+                "params": {"dirpath": os.path.join(ckptdir, "sharded")},
+            }
+            # replaces the step-based synchronous checkpoints, the
+            # checkpoint_callback still saves at the end of validation epochs
+            if "every_n_train_steps" in modelckpt_cfg.params:
+                rank_zero_print(
+                    "sharded_checkpoint: ignoring modelcheckpoint every_n_train_steps"
+                )
+                del modelckpt_cfg.params["every_n_train_steps"]
+
         callbacks_cfg = OmegaConf.merge(default_callbacks_cfg, callbacks_cfg)
+        if (
+            "sharded_checkpoint" in callbacks_cfg
+            and "metrics_over_trainsteps_checkpoint" in callbacks_cfg
+        ):
+            rank_zero_print(
+                "sharded_checkpoint: disabling metrics_over_trainsteps_checkpoint"
+            )
+            del callbacks_cfg["metrics_over_trainsteps_checkpoint"]
         if "ignore_keys_callback" in callbacks_cfg and hasattr(
             trainer_opt, "resume_from_checkpoint"
         ):
@@ -992,6 +1271,13 @@ if __name__ == "__main__":
             from pytorch_lightning.plugins import DDPPlugin
 
             trainer_kwargs["plugins"].append(DDPPlugin(find_unused_parameters=False))
+            # DDP then expects a gradient for every parameter, the single token
+            # path of CrossAttention skips to_q and to_k
+            from ldm.modules.attention import CrossAttention
+
+            for module in model.modules():
+                if isinstance(module, CrossAttention):
+                    module.single_token_fast_path = False
         if MULTINODE_HACKS:
             # disable resume from hpc ckpts
             # NOTE below only works in later versions
@@ -0,0 +1,99 @@
+"""Micro-benchmark of the multi-view noise aggregation.
+
+Compares `aggregate_views` against the padded implementation it replaced in
+`LatentDiffusion.p_losses` and `DDIMSampler.p_sample_ddim`, checks that both
+agree and reports the time per call (forward + backward with --backward).
+
+Usage:
+    python scripts/bench_aggregate_views.py --batch_size 32 --device cuda
+"""
+
+import time
+
+import fire
+import torch
+from ldm.modules.diffusionmodules.util import aggregate_views
+
+
+def aggregate_views_padded(model_output, cond_counts):
+    view_delimiters = torch.cumsum(cond_counts, 0).tolist()
+    view_delimiters.insert(0, 0)
+    noise_weight_delim = model_output.shape[1] // 2
+    noise_all, logits = (
+        model_output[:, :noise_weight_delim, ...],
+        model_output[:, noise_weight_delim:, ...],
+    )
+    logits_padded = torch.nn.utils.rnn.pad_sequence(
+        [
+            logits[idx1:idx2]
+            for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
+        ],
+        batch_first=True,
+        padding_value=float("-inf"),
+    )
+    weights_softmax = torch.nn.functional.softmax(logits_padded, dim=1)
+    noise_padded = torch.nn.utils.rnn.pad_sequence(
+        [
+            noise_all[idx1:idx2]
+            for idx1, idx2 in zip(view_delimiters[:-1], view_delimiters[1:])
+        ],
+        batch_first=True,
+    )
+    noise_weighted = noise_padded * weights_softmax
+    return noise_weighted.sum(dim=1)
+
+
+def time_fn(fn, model_output, cond_counts, iters, backward):
+    def step():
+        out = fn(model_output, cond_counts)
+        if backward:
+            out.sum().backward()
+
+    for _ in range(3):
+        step()
+    if model_output.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    if model_output.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1e3
+
+
+def main(
+    batch_size=32,
+    channels=4,
+    resolution=32,
+    max_cond_count=6,
+    iters=100,
+    device="cuda",
+    backward=False,
+    seed=0,
+):
+    torch.manual_seed(seed)
+    cond_counts = torch.randint(1, max_cond_count + 1, (batch_size,))
+    model_output = torch.randn(
+        int(cond_counts.sum()),
+        2 * channels,
+        resolution,
+        resolution,
+        device=device,
+        requires_grad=backward,
+    )
+
+    with torch.no_grad():
+        reference = aggregate_views_padded(model_output, cond_counts)
+        out = aggregate_views(model_output, cond_counts)
+    print(f"max abs difference: {(reference - out).abs().max().item():.3e}")
+
+    for name, fn in [
+        ("padded", aggregate_views_padded),
+        ("aggregate_views", aggregate_views),
+    ]:
+        ms = time_fn(fn, model_output, cond_counts, iters, backward)
+        print(f"{name:>16}: {ms:.3f} ms/call")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
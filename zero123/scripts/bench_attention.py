@@ -0,0 +1,77 @@
+"""Parity check and memory/latency report of the attention backends.
+
+Runs the self-attention of a UNet transformer block (CrossAttention) and the
+UNet's QKVAttention at the given resolution with every available backend of
+`ldm.modules.attention.set_attention_backend`, and reports the largest
+difference to the naive backend, the peak memory and the time per call.
+
+Usage:
+    python scripts/bench_attention.py --rows 48 --resolution 32 --dtype float16
+"""
+
+import time
+
+import fire
+import torch
+import torch.nn.functional as F
+from ldm.modules.attention import CrossAttention, set_attention_backend
+from ldm.modules.diffusionmodules.openaimodel import QKVAttention
+
+
+def measure(fn, iters):
+    for _ in range(2):
+        fn()
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    base = torch.cuda.memory_allocated()
+    start = time.perf_counter()
+    for _ in range(iters):
+        out = fn()
+    torch.cuda.synchronize()
+    ms = (time.perf_counter() - start) / iters * 1e3
+    peak_mb = (torch.cuda.max_memory_allocated() - base) / 2**20
+    return out, ms, peak_mb
+
+
+@torch.no_grad()
+def main(
+    rows=48,
+    resolution=32,
+    channels=320,
+    heads=8,
+    chunk_size=1024,
+    dtype="float16",
+    iters=20,
+):
+    dtype = getattr(torch, dtype)
+    n = resolution * resolution
+    cross_attn = CrossAttention(channels, heads=heads, dim_head=channels // heads)
+    cross_attn = cross_attn.cuda().to(dtype).eval()
+    x = torch.randn(rows, n, channels, device="cuda", dtype=dtype)
+    qkv_attn = QKVAttention(heads)
+    qkv = torch.randn(rows, 3 * channels, n, device="cuda", dtype=dtype)
+
+    backends = ["naive", "chunked"]
+    if hasattr(F, "scaled_dot_product_attention"):
+        backends.append("sdpa")
+
+    for name, module, fn in [
+        ("CrossAttention", cross_attn, lambda: cross_attn(x)),
+        ("QKVAttention", qkv_attn, lambda: qkv_attn(qkv)),
+    ]:
+        print(f"{name}: {rows} x {n} tokens, {channels} channels, {dtype}")
+        reference = None
+        for backend in backends:
+            set_attention_backend(module, backend, chunk_size)
+            out, ms, peak_mb = measure(fn, iters)
+            if reference is None:
+                reference = out
+            diff = (out.float() - reference.float()).abs().max().item()
+            print(
+                f"{backend:>10}: {ms:8.3f} ms  {peak_mb:9.1f} MB peak  "
+                f"max abs diff {diff:.3e}"
+            )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,67 @@
+"""Activation memory and step time of UNet checkpointing policies.
+
+Instantiates the UNet of a training config and runs forward + backward passes
+on random inputs for every policy, reporting the peak memory on top of the
+weights and gradients and the time per step. A policy holds the keyword
+arguments of `UNetModel.set_checkpoint_policy`; the best one can be copied
+into `unet_config.params.checkpoint_policy`.
+
+Usage:
+    python scripts/bench_checkpointing.py \
+        --config configs/sd-objaverse-finetune-c_concat-256.yaml --rows 48
+"""
+
+import time
+
+import fire
+import torch
+from ldm.util import instantiate_from_config
+from omegaconf import OmegaConf
+
+DEFAULT_POLICIES = {
+    "none": {"levels": []},
+    "all": {},
+    "attention": {"block_types": ["attention"]},
+    "resblock": {"block_types": ["resblock"]},
+    "levels_0_1": {"levels": [0, 1]},
+    "every_2": {"every": 2},
+}
+
+
+def main(config, rows=48, iters=5, policies=None, dtype="float32"):
+    config = OmegaConf.load(config)
+    unet_config = config.model.params.unet_config
+    unet = instantiate_from_config(unet_config).cuda().train()
+    dtype = getattr(torch, dtype)
+
+    size = config.model.params.image_size
+    x = torch.randn(rows, unet.in_channels, size, size, device="cuda")
+    t = torch.randint(0, 1000, (rows,), device="cuda")
+    context = torch.randn(rows, 1, unet_config.params.context_dim, device="cuda")
+
+    def step():
+        with torch.autocast("cuda", dtype=dtype, enabled=dtype != torch.float32):
+            out = unet(x, t, context=context)
+        out.float().square().mean().backward()
+
+    for name, policy in (policies or DEFAULT_POLICIES).items():
+        count = unet.set_checkpoint_policy(**policy)
+        step()
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(iters):
+            step()
+        torch.cuda.synchronize()
+        ms = (time.perf_counter() - start) / iters * 1e3
+        peak_gb = (torch.cuda.max_memory_allocated() - base) / 2**30
+        print(
+            f"{name:>12} ({count:3d} blocks): {peak_gb:7.2f} GB activations, "
+            f"{ms:8.1f} ms/step"
+        )
+        unet.zero_grad(set_to_none=False)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
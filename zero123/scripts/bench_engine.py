@@ -0,0 +1,98 @@
+"""Per-request latency outside the UNet, fresh sampler vs InferenceEngine.
+
+Serves the same single-pose request `requests` times, once the way the demos
+used to (a new DDIMSampler and encoder pass per request) and once through
+`ldm.engine.InferenceEngine`. Reports the time per request spent in and
+outside of `apply_model`, and checks that both paths produce the same samples
+for the same seed.
+
+Usage:
+    python scripts/bench_engine.py \
+        --config configs/sd-objaverse-finetune-c_concat-256-test.yaml --ckpt last.ckpt
+"""
+
+import time
+
+import fire
+import torch
+from ldm.engine import InferenceEngine
+from ldm.models.diffusion.ddim import DDIMSampler
+from ldm.orbit import encode_input, sample_poses
+from ldm.util import instantiate_from_config
+from omegaconf import OmegaConf
+
+
+class UNetTimer:
+    """Accumulates the synchronized wall time of `model.apply_model`."""
+
+    def __init__(self, model):
+        self.seconds = 0.0
+        self.apply_model = model.apply_model
+        model.apply_model = self
+
+    def __call__(self, *args, **kwargs):
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = self.apply_model(*args, **kwargs)
+        torch.cuda.synchronize()
+        self.seconds += time.perf_counter() - start
+        return out
+
+
+def fresh_request(model, input_im, pose, **kwargs):
+    encoded = encode_input(model, input_im)
+    _, images = next(
+        sample_poses(model, encoded, [pose], sampler=DDIMSampler(model), **kwargs)
+    )
+    return images
+
+
+def main(
+    config,
+    ckpt=None,
+    requests=5,
+    ddim_steps=50,
+    n_samples=4,
+    scale=3.0,
+    size=256,
+    seed=0,
+):
+    config = OmegaConf.load(config)
+    if ckpt is not None:
+        engine = InferenceEngine.from_config(config, ckpt, "cuda")
+    else:
+        model = instantiate_from_config(config.model).cuda().eval()
+        engine = InferenceEngine(model)
+    model = engine.model
+    input_im = torch.rand(1, 3, size, size, device="cuda") * 2 - 1
+    pose = (0.3, 1.0, 0.0)
+    kwargs = dict(n_samples=n_samples, ddim_steps=ddim_steps, scale=scale)
+
+    torch.manual_seed(seed)
+    reference = fresh_request(model, input_im, pose, **kwargs)
+    torch.manual_seed(seed)
+    out = engine.sample_pose(input_im, pose, **kwargs)
+    print(f"max abs difference: {(reference - out).abs().max().item():.3e}")
+
+    timer = UNetTimer(model)
+    for name, request in [
+        ("fresh sampler", lambda: fresh_request(model, input_im, pose, **kwargs)),
+        ("engine", lambda: engine.sample_pose(input_im, pose, **kwargs)),
+    ]:
+        request()
+        timer.seconds = 0.0
+        torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(requests):
+            request()
+        torch.cuda.synchronize()
+        total_ms = (time.perf_counter() - start) / requests * 1e3
+        unet_ms = timer.seconds / requests * 1e3
+        print(
+            f"{name:>14}: {total_ms:8.1f} ms/request, {unet_ms:8.1f} ms in the UNet, "
+            f"{total_ms - unet_ms:7.1f} ms outside"
+        )
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,149 @@
+"""Quality and latency of DDIM vs DPM-Solver++ 2M on GSO / RTMV objects.
+
+Renders the held-out views of the first `num_objects` objects of the dataset
+from their first view with every `sampler:steps` setting, with the same seed
+for all settings, and reports the latency per object and the PSNR / LPIPS of
+the samples against the ground truth views.
+
+Usage:
+    python scripts/bench_samplers.py --config configs/sd-objaverse-finetune-c_concat-256.yaml \
+        --ckpt 105000.ckpt --dataset gso --root_dir datasets/GoogleScannedObjects \
+        --settings ddim:50,ddim:20,dpmpp_2m:20,dpmpp_2m:15
+"""
+
+import json
+import math
+import time
+
+import fire
+import torch
+from ldm.checkpoint import load_model
+from ldm.data.nerf_like import GSO, RTMV, get_spherical
+from ldm.engine import InferenceEngine
+from omegaconf import OmegaConf
+
+DATASETS = {"gso": GSO, "rtmv": RTMV}
+
+
+def relative_poses(poses):
+    """`(elevation, azimuth, radius)` of every view relative to the first."""
+    out = []
+    for c2w in poses[1:]:
+        d_theta, d_azimuth, d_z = get_spherical(
+            c2w[:3, 3].numpy(), poses[0][:3, 3].numpy()
+        ).tolist()
+        out.append((math.radians(d_theta), math.radians(d_azimuth), d_z))
+    return out
+
+
+def psnr(x, y):
+    mse = ((x - y) ** 2).flatten(1).mean(1)
+    return -10.0 * torch.log10(mse)
+
+
+def parse_settings(settings):
+    if isinstance(settings, str):
+        settings = settings.split(",")
+    out = []
+    for setting in settings:
+        name, steps = setting.split(":")
+        out.append((name, int(steps)))
+    return out
+
+
+def main(
+    config,
+    ckpt,
+    dataset="gso",
+    root_dir=None,
+    num_objects=8,
+    first_K=5,
+    settings="ddim:50,ddim:20,dpmpp_2m:20,dpmpp_2m:15",
+    n_samples=1,
+    scale=3.0,
+    seed=0,
+    out=None,
+):
+    """
+    :param first_K: views loaded per object, the first is the input.
+    :param settings: comma separated `sampler:steps`, see `ldm.engine.SAMPLERS`.
+    :param out: optional json file the results are written to.
+    """
+    from taming.modules.losses.lpips import LPIPS
+
+    model = load_model(OmegaConf.load(config), ckpt, "cuda")
+    kwargs = dict(first_K=first_K, load_target=True)
+    if root_dir is not None:
+        kwargs["root_dir"] = root_dir
+    data = DATASETS[dataset](**kwargs)
+    lpips = LPIPS().cuda().eval()
+    settings = parse_settings(settings)
+    engines = {name: InferenceEngine(model, sampler=name) for name, _ in settings}
+    results = {
+        setting: {"seconds": [], "psnr": [], "lpips": []} for setting in settings
+    }
+
+    # warm up every setting, so that the first object is not slower
+    imgs, poses = data[0]
+    warmup_poses = relative_poses(poses)[:1]
+    for name, steps in settings:
+        next(engines[name].sample(imgs[:1].cuda(), warmup_poses, ddim_steps=steps))
+
+    for idx in range(min(num_objects, len(data))):
+        imgs, poses = data[idx]
+        input_im = imgs[:1].cuda()
+        targets = (imgs[1:].cuda() + 1.0) / 2.0
+        poses = relative_poses(poses)
+        encoded = engines[settings[0][0]].encode(input_im)
+        for name, steps in settings:
+            torch.manual_seed(seed)
+            torch.cuda.synchronize()
+            start = time.perf_counter()
+            samples = [
+                images
+                for _, images in engines[name].sample(
+                    input_im,
+                    poses,
+                    n_samples=n_samples,
+                    ddim_steps=steps,
+                    scale=scale,
+                    encoded=encoded,
+                )
+            ]
+            torch.cuda.synchronize()
+            result = results[(name, steps)]
+            result["seconds"].append(time.perf_counter() - start)
+            # [views, n_samples, 3, H, W] against the target of every view
+            samples = torch.stack(samples).cuda()
+            target = targets[:, None].expand_as(samples)
+            samples, target = samples.flatten(0, 1), target.flatten(0, 1)
+            result["psnr"].extend(psnr(samples, target).tolist())
+            with torch.no_grad():
+                d = lpips(samples * 2 - 1, target * 2 - 1)
+            result["lpips"].extend(d.flatten().tolist())
+        print(f"object {idx + 1}/{min(num_objects, len(data))} done")
+
+    summary = []
+    for (name, steps), result in results.items():
+        summary.append(
+            {
+                "sampler": name,
+                "steps": steps,
+                "ms_per_object": 1e3 * sum(result["seconds"]) / len(result["seconds"]),
+                "psnr": sum(result["psnr"]) / len(result["psnr"]),
+                "lpips": sum(result["lpips"]) / len(result["lpips"]),
+            }
+        )
+    print(f"{'sampler':>10} {'steps':>5} {'ms/object':>10} {'PSNR':>7} {'LPIPS':>7}")
+    for row in summary:
+        print(
+            f"{row['sampler']:>10} {row['steps']:>5} {row['ms_per_object']:>10.1f} "
+            f"{row['psnr']:>7.2f} {row['lpips']:>7.4f}"
+        )
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
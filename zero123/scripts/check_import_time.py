@@ -0,0 +1,68 @@
+"""Import-time regression check for the model code.
+
+Imports each module in a fresh interpreter, best of `repeats` runs, and fails
+if that takes longer than `budget` seconds or pulls in one of the optional
+dependencies that should only load on first use (carvekit, cv2, diffusers,
+transformers, ...). Run it from the zero123 directory, e.g. in CI:
+
+    python scripts/check_import_time.py --budget 6.0
+"""
+
+import json
+import subprocess
+import sys
+
+import fire
+
+DEFAULT_MODULES = ["ldm.models.diffusion.ddpm"]
+LAZY_DEPENDENCIES = [
+    "carvekit",
+    "cv2",
+    "diffusers",
+    "transformers",
+    "lovely_numpy",
+    "lovely_tensors",
+    "rich",
+    "matplotlib",
+]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+loaded = sorted({{name.split(".")[0] for name in sys.modules}})
+print(json.dumps({{"seconds": seconds, "loaded": loaded}}))
+"""
+
+
+def probe(module):
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module)],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(budget=6.0, modules=None, repeats=3):
+    failed = False
+    for module in modules or DEFAULT_MODULES:
+        runs = [probe(module) for _ in range(repeats)]
+        seconds = min(run["seconds"] for run in runs)
+        eager = sorted(set(LAZY_DEPENDENCIES) & set(runs[0]["loaded"]))
+        ok = seconds <= budget and not eager
+        failed |= not ok
+        print(
+            f"{'ok' if ok else 'FAIL':>4} {module}: {seconds:.2f}s "
+            f"(budget {budget:.2f}s)"
+        )
+        if eager:
+            print(f"     imports optional dependencies eagerly: {', '.join(eager)}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
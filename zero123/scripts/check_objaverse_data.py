@@ -0,0 +1,97 @@
+"""Smoke test of ObjaverseData on a synthetic object.
+
+Writes one object with `total_view` random RGBA views and cameras to a
+temporary directory, builds the dataset the way ObjaverseDataModuleFromConfig
+does for the float and the uint8 path, and loads a sample from each, with one
+and with several tuples per object. Fails on the first error:
+
+    python scripts/check_objaverse_data.py
+"""
+
+import json
+import os
+import tempfile
+
+import fire
+import numpy as np
+import torch
+import torchvision
+from einops import rearrange
+from ldm.data.simple import ObjaverseData, multiview_collate
+from PIL import Image
+from torchvision import transforms
+
+UID = "0" * 32
+
+
+def write_object(root_dir, total_view, size):
+    rng = np.random.default_rng(0)
+    os.makedirs(os.path.join(root_dir, UID))
+    for view in range(total_view):
+        im = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+        im[: size // 4, :, 3] = 0  # some background
+        Image.fromarray(im, "RGBA").save(os.path.join(root_dir, UID, "%03d.png" % view))
+        azimuth = 2 * np.pi * view / total_view
+        RT = np.zeros((3, 4), dtype=np.float32)
+        RT[:3, :3] = np.eye(3)
+        RT[:, 3] = [np.cos(azimuth) * 1.5, np.sin(azimuth) * 1.5, 0.5]
+        np.save(os.path.join(root_dir, UID, "%03d.npy" % view), RT)
+    with open(os.path.join(root_dir, "valid_paths.json"), "w") as f:
+        json.dump([UID], f)
+    with open(os.path.join(root_dir, "clean.json"), "w") as f:
+        json.dump([UID], f)
+
+
+def image_transforms(uint8, size):
+    tforms = [torchvision.transforms.Resize(size)]
+    if not uint8:
+        tforms.extend(
+            [
+                transforms.ToTensor(),
+                transforms.Lambda(lambda x: rearrange(x * 2.0 - 1.0, "c h w -> h w c")),
+            ]
+        )
+    return torchvision.transforms.Compose(tforms)
+
+
+def check_sample(sample, uint8, size):
+    target = sample["image_target"]
+    if uint8:
+        assert target.dtype == torch.uint8, target.dtype
+        assert target.shape == (3, size, size), target.shape
+    else:
+        assert target.dtype == torch.float32, target.dtype
+        assert target.shape == (size, size, 3), target.shape
+        assert -1.0 <= target.min() and target.max() <= 1.0
+    assert sample["image_cond"].shape[0] == sample["cond_count"]
+    assert sample["T"].shape == (4,), sample["T"].shape
+
+
+def main(total_view=12, size=64):
+    with tempfile.TemporaryDirectory() as root_dir:
+        write_object(root_dir, total_view, size * 2)
+        for uint8 in [False, True]:
+            for tuples_per_object in [1, 3]:
+                dataset = ObjaverseData(
+                    root_dir=root_dir,
+                    paths_dir=root_dir,
+                    total_view=total_view,
+                    # a single object only makes it into the validation split
+                    validation=True,
+                    image_transforms=image_transforms(uint8, size),
+                    # raise read errors instead of using the fallback object
+                    clean_index=os.path.join(root_dir, "clean.json"),
+                    uint8=uint8,
+                    tuples_per_object=tuples_per_object,
+                )
+                item = dataset[0]
+                samples = item if tuples_per_object > 1 else [item]
+                assert len(samples) == tuples_per_object
+                for sample in samples:
+                    check_sample(sample, uint8, size)
+                multiview_collate([item, item])
+                print(f"ok uint8={uint8} tuples_per_object={tuples_per_object}")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)